@@ -2,6 +2,8 @@ import os
 import functools
 import logging
 import ctypes
+import importlib
+import time
 from PyQt5.QtCore import QAbstractListModel, QModelIndex, QRect, QTimer, Qt, QStandardPaths
 from PyQt5.QtGui import  QBrush, QColor, QImage, QPainter, QPen, QIcon, QDesktopServices
 from PyQt5.QtWidgets import QApplication, QDialog, QMessageBox,  \
@@ -21,36 +23,42 @@ def moveToCenter(window):
     r.moveCenter(QApplication.instance().desktop().screenGeometry().center())
     window.setGeometry(r)
 
+def resolveFactory(factory):
+    "部件的factory可以是一个函数或者类，也可以是\"包名.模块名.类名\"这样的字符串，用到的时候才导入模块"
+    if not isinstance(factory, str):
+        return factory
+    moduleName, _, attrName = factory.rpartition(".")
+    return getattr(importlib.import_module(moduleName), attrName)
+
 class WidgetManager:
     """QuickPanel类的一部分，分出来方便阅读与理解。主要功能是管理快捷面板的部件"""
 
     def initWidgets(self):
         self.widgets = []
+        self.newWidgetConfigs = []
 
-        from besteam.im.quick_panel.widgets.todo_list import TodoListWidget
-        from besteam.im.quick_panel.widgets.quick_access import QuickAccessWidget
-        from besteam.im.quick_panel.widgets.textpad import TextpadWidget
-        from besteam.im.quick_panel.widgets.desktop_icon import DesktopIconWidget
-        from besteam.im.quick_panel.widgets.machine_load import MachineLoadWidget
-        from besteam.im.quick_panel.widgets.calendar import CalendarWidget
+        #内置部件使用字符串形式的factory，没有启用的部件不会导入它的模块
         self.registerWidget("bc8ada4f-50b8-49f7-917a-da163b6763e9", self.tr("待办事项列表"), \
                 self.tr("用于纪录当前正在进行中的待办事项。"), \
-                TodoListWidget)
+                "besteam.im.quick_panel.widgets.todo_list.TodoListWidget")
         self.registerWidget("be6c197b-0181-47c0-a9fc-6a1fe5f1b3e6", self.tr("Besteam快捷方式"), \
                 self.tr("快捷启动Besteam的附加工具。"), \
-                QuickAccessWidget)
+                "besteam.im.quick_panel.widgets.quick_access.QuickAccessWidget")
         self.registerWidget("45d1ee54-f9bd-435e-93cf-b46a05b56514", self.tr("文本框"), \
                 self.tr("简单纪录文本。退出Besteam被丢弃。"), \
-                TextpadWidget)
+                "besteam.im.quick_panel.widgets.textpad.TextpadWidget")
         self.registerWidget("dd6afcb0-e223-4156-988d-20f20266c6f0", self.tr("桌面快捷方式"), \
                 self.tr("启动外部程序。"), \
-                DesktopIconWidget)
+                "besteam.im.quick_panel.widgets.desktop_icon.DesktopIconWidget")
         self.registerWidget("b0b6b9eb-aec0-4fe5-bfd0-d4d317fdd547", self.tr("CPU使用率"), \
                 self.tr("以折线的形式显示一段时间内的CPU使用率。"), \
-                MachineLoadWidget)
+                "besteam.im.quick_panel.widgets.machine_load.MachineLoadWidget")
         self.registerWidget("d94db588-663b-4a6f-b935-4ca9ff283c75", self.tr("现在时间"),\
                 self.tr("显示当前时间。"), \
-                CalendarWidget)
+                "besteam.im.quick_panel.widgets.calendar.CalendarWidget")
+        newWidgetConfigs, self.newWidgetConfigs = self.newWidgetConfigs, None
+        if newWidgetConfigs:
+            self.db.addWidgetConfigs(newWidgetConfigs)
         logger.debug("All builtin widgets have been registered.")
 
     def finalize(self):
@@ -70,7 +78,7 @@ class WidgetManager:
 
     def registerWidget(self, id, name, description, factory):
         widget = WidgetConfigure()
-        config = self.db.getWidgetConfig(id)
+        config = self.widgetConfigs.get(id)
         if config is None:
             config = {}
             config["id"] = id
@@ -79,7 +87,12 @@ class WidgetManager:
             config["width"] = 10
             config["height"] = 10
             config["enabled"] = False
-            self.db.saveWidgetConfig(config)
+            self.widgetConfigs[id] = config
+            #initWidgets()注册的新部件在最后一起保存
+            if self.newWidgetConfigs is None:
+                self.db.saveWidgetConfig(config)
+            else:
+                self.newWidgetConfigs.append(config)
             widget.rect = QRect(15, 10, 10, 10)
             widget.enabled = False
         else:
@@ -122,15 +135,20 @@ class WidgetManager:
     def _enableWidget(self, widget, syncToDatabase = True):
         if widget.widget is not None:
             return
+        startTime = time.perf_counter()
         try:
+            widget.factory = resolveFactory(widget.factory)
             widget.widget = widget.factory(self.canvas)
         except:
             logger.exception("error occured while call widget's factory function.")
             return
+        logger.debug("widget %s is enabled in %.1fms.", widget.id, (time.perf_counter() - startTime) * 1000)
         widget.enabled = True
         self.canvas.showWidget(widget)
         if syncToDatabase:
             self.db.setWidgetEnabled(widget.id, True)
+            if widget.id in self.widgetConfigs:
+                self.widgetConfigs[widget.id]["enabled"] = True
 
     def _disableWidget(self, widget, syncToDatabase = True):
         if widget.widget is None:
@@ -147,6 +165,8 @@ class WidgetManager:
         widget.enabled = False
         if syncToDatabase:
             self.db.setWidgetEnabled(widget.id, False)
+            if widget.id in self.widgetConfigs:
+                self.widgetConfigs[widget.id]["enabled"] = False
 
     def selectWidgets(self):
         self.layoutEditor.selectWidgets()
@@ -171,6 +191,9 @@ class QuickPanel(QWidget, WidgetManager):
         self.setWindowModality(Qt.ApplicationModal)
         self.platform = platform
         self.db = QuickPanelDatabase(platform.databaseFile)
+        #部件的配置一次读出来，注册部件的时候不再逐个查询数据库
+        self.widgetConfigs = self.db.getWidgetConfigs()
+        self.newWidgetConfigs = None
         self.createActions()
         self.createControls()
         self.loadSettings()
@@ -246,14 +269,40 @@ class QuickPanel(QWidget, WidgetManager):
         self.layoutEditor.hide()
 
     def loadSettings(self):
+        #标题与背景图片只在相应的设置改变的时候才重新生成
+        self._backgroundPath = None
+        self._backgroundSource = None
+        self._backgroundDesktopSize = None
         settings = self.platform.getSettings()
-        filepath = settings.value("background", "background.png")
+        settings.watch("globalkey", self.onGlobalKeyChanged)
+        settings.watch("background", self.onBackgroundChanged)
+        self.onGlobalKeyChanged("/globalkey", settings.value("globalkey", "Alt+`"))
+        self.onBackgroundChanged("/background", settings.value("background"))
+
+    def onGlobalKeyChanged(self, key, value):
+        if value is None:
+            value = "Alt+`"
+        if os.name == "nt": #在Windows系统下，Meta键习惯叫Win键
+            value = value.replace("Meta", "Win")
+        title = self.tr("提示：在任何位置按<b>{0}</b>打开快捷面板。").format(value)
+        self.lblTitle.setText('<span style=" font-size:14pt;font-style:italic;">{0}</span>'.format(title))
+
+    def onBackgroundChanged(self, key, value):
+        filepath = value or "background.png"
         if not os.path.exists(filepath):
             filepath = os.path.join(os.path.dirname(__file__), filepath)
-        if not os.path.exists(filepath):
+        #changeBackground()已经设置好了同一张图片
+        if not os.path.exists(filepath) or filepath == self._backgroundPath:
             return
         image = QImage(filepath)
+        if image.isNull():
+            return
+        self._backgroundPath = filepath
         self._makeBackground(image)
+        if self.isVisible():
+            moveToCenter(self)
+            self.canvas.positWidgets()
+            self.update()
 
     def makeConnections(self):
         self.actionClose.triggered.connect(self.close)
@@ -283,19 +332,9 @@ class QuickPanel(QWidget, WidgetManager):
             self.close()
 
     def showEvent(self, event):
-        settings = self.platform.getSettings()
-        key = settings.value("globalkey", "Alt+`")
-        if key is not None:
-            if os.name == "nt": #在Windows系统下，Meta键习惯叫Win键
-                key = key.replace("Meta", "Win")
-            title = self.tr("提示：在任何位置按<b>{0}</b>打开快捷面板。").format(key)
-            self.lblTitle.setText('<span style=" font-size:14pt;font-style:italic;">{0}</span>'.format(title))
-        else:
-            title = self.tr("快捷面板")
-            self.lblTitle.setText('<span style=" font-size:14pt;font-style:italic;">{0}</span>'.format(title))
-
-        #如果有时候运行全屏程序，快捷面板的位置就会发生改变
-        self._makeBackground(self._background_image)
+        #如果有时候运行全屏程序，快捷面板的位置就会发生改变。屏幕大小没变的话不会重新缩放背景图片
+        if self._backgroundSource is not None:
+            self._makeBackground(self._backgroundSource)
         moveToCenter(self)
         self.canvas.positWidgets()
         QWidget.showEvent(self, event)
@@ -343,6 +382,7 @@ class QuickPanel(QWidget, WidgetManager):
         self.toolBarLayout.hide()
         self.toolBarMain.show()
         changedWidgets = self.layoutEditor.saveLayout(self.widgets)
+        configs = []
         for widget in changedWidgets:
             conf = {}
             conf["left"] = widget.rect.left()
@@ -351,7 +391,12 @@ class QuickPanel(QWidget, WidgetManager):
             conf["height"] = widget.rect.height()
             conf["enabled"] = widget.enabled
             conf["id"] = widget.id
-            self.db.saveWidgetConfig(conf)
+            configs.append(conf)
+        #部件注册的时候已经保证数据库里有它的配置，所以这里只需要批量更新
+        self.db.saveWidgetConfigs(configs)
+        for conf in configs:
+            self.widgetConfigs[conf["id"]] = conf
+        for widget in changedWidgets:
             if widget.enabled:
                 self._enableWidget(widget, False)
             else:
@@ -384,6 +429,7 @@ class QuickPanel(QWidget, WidgetManager):
             if answer == QMessageBox.No:
                 return
         self._makeBackground(image)
+        self._backgroundPath = filename
         moveToCenter(self)
         self.canvas.positWidgets()
         self.update()
@@ -398,6 +444,7 @@ class QuickPanel(QWidget, WidgetManager):
             image = QImage(filename)
             if not image.isNull():
                 self._makeBackground(image)
+                self._backgroundPath = filename
                 moveToCenter(self)
                 self.canvas.positWidgets()
                 self.update()
@@ -406,6 +453,10 @@ class QuickPanel(QWidget, WidgetManager):
 
     def _makeBackground(self, image):
         desktopSize = QApplication.desktop().screenGeometry(self).size()
+        if image is self._backgroundSource and desktopSize == self._backgroundDesktopSize:
+            return
+        self._backgroundSource = image
+        self._backgroundDesktopSize = desktopSize
         if desktopSize.width() < image.width() or desktopSize.height() < image.height():
             self._background_image = image.scaled(desktopSize, Qt.KeepAspectRatio, Qt.SmoothTransformation)
         else:
@@ -42,7 +42,6 @@ class QuickPanelDatabase(Database):
             desktopIconWidget["top"] = 0
             desktopIconWidget["width"] = 20
             desktopIconWidget["height"] = 22
-            self.insertQuickPanelWidget(desktopIconWidget)
 
             machineLoadWidget = {}
             machineLoadWidget["id"] = "b0b6b9eb-aec0-4fe5-bfd0-d4d317fdd547"
@@ -51,7 +50,6 @@ class QuickPanelDatabase(Database):
             machineLoadWidget["top"] = 22
             machineLoadWidget["width"] = 20
             machineLoadWidget["height"] = 5
-            self.insertQuickPanelWidget(machineLoadWidget)
 
             calendarWidget = {}
             calendarWidget["id"] = "d94db588-663b-4a6f-b935-4ca9ff283c75"
@@ -60,7 +58,6 @@ class QuickPanelDatabase(Database):
             calendarWidget["top"] = 27
             calendarWidget["width"] = 20
             calendarWidget["height"] = 3
-            self.insertQuickPanelWidget(calendarWidget)
 
             quickAccessWidget = {}
             quickAccessWidget["id"] = "be6c197b-0181-47c0-a9fc-6a1fe5f1b3e6"
@@ -70,7 +67,6 @@ class QuickPanelDatabase(Database):
             quickAccessWidget["width"] = 20
             quickAccessWidget["height"] = 6
             quickAccessWidget["factory"] = "im.quick_panel.widgets.quick_access.QuickAccessWidget"
-            self.insertQuickPanelWidget(quickAccessWidget)
 
             todoListWidget = {}
             todoListWidget["id"] = "bc8ada4f-50b8-49f7-917a-da163b6763e9"
@@ -79,7 +75,6 @@ class QuickPanelDatabase(Database):
             todoListWidget["top"] = 6
             todoListWidget["width"] = 20
             todoListWidget["height"] = 16
-            self.insertQuickPanelWidget(todoListWidget)
 
             textpadWidget = {}
             textpadWidget["id"] = "45d1ee54-f9bd-435e-93cf-b46a05b56514"
@@ -88,20 +83,30 @@ class QuickPanelDatabase(Database):
             textpadWidget["top"] = 22
             textpadWidget["width"] = 20
             textpadWidget["height"] = 8
-            self.insertQuickPanelWidget(textpadWidget)
+
+            self.insertManyQuickPanelWidget([desktopIconWidget, machineLoadWidget, calendarWidget,
+                    quickAccessWidget, todoListWidget, textpadWidget])
 
     def getWidgetConfig(self, id):
-        rows = self.selectQuickPanelWidget("where id=?", id)
+        rows = self.selectRowsQuickPanelWidget("where id=?", id)
         if not rows:
             return None
-        return dict(rows[0])
+        return dict(rows[0]._asdict())
+
+    def getWidgetConfigs(self):
+        "一次读出所有部件的配置，返回以部件id为键的字典。"
+        return dict((row.id, dict(row._asdict())) for row in self.selectRowsQuickPanelWidget(""))
 
     def saveWidgetConfig(self, config):
-        rows = self.selectQuickPanelWidget("where id=?", config["id"])
-        if rows:
-            self.updateQuickPanelWidget(config, "where id=?", config["id"])
-        else:
-            self.insertQuickPanelWidget(config)
+        self.upsertQuickPanelWidget(config)
+
+    def addWidgetConfigs(self, configs):
+        "在一个事务里批量保存新部件的配置。"
+        self.upsertManyQuickPanelWidget(configs)
+
+    def saveWidgetConfigs(self, configs):
+        "批量保存已经存在的部件配置。"
+        self.updateManyQuickPanelWidget(configs)
 
     def setWidgetEnabled(self, id, enabled):
         self.updateQuickPanelWidget({"enabled": enabled}, "where id=?", id)
@@ -6,7 +6,7 @@ from PyQt5.QtCore import QAbstractListModel, QFileInfo, QModelIndex, QProcess, Q
 from PyQt5.QtGui import QDesktopServices, QIcon, QImage, QPixmap, QCursor
 from PyQt5.QtWidgets import QAbstractItemView, QListView, QMenu, QHBoxLayout, QFileDialog, \
         QMessageBox, QDialog, QFrame, QFileIconProvider, QAction
-from besteam.utils.sql import Table, Database
+from besteam.utils.sql import Table, Database, databaseExecutor
 from .Ui_shortcut import Ui_ShortcutDialog
 from .Ui_bookmark import Ui_BookmarkDialog
 
@@ -240,7 +240,22 @@ class QuickDesktopModel(QAbstractListModel):
     def __init__(self, databaseFile):
         QAbstractListModel.__init__(self)
         self.db = ShortcutDatabase(databaseFile)
-        self.shortcuts = self.db.selectShortcut("")
+        #在后台线程里读取快捷方式，读取完成之前显示空白的桌面。后台线程只读取namedtuple，
+        #在界面线程里才转换成数据对象，避免后台线程修改界面正在使用的数据对象
+        self.shortcuts = []
+        #读取期间修改或者删除过的快捷方式的ID，读取的结果里这些快捷方式可能是旧的
+        self.changedWhileLoading = set()
+        databaseExecutor.submit(self.db.selectRowsShortcut, "", callback = self.setShortcuts)
+
+    def setShortcuts(self, rows):
+        "后台线程读取完成以后调用。读取期间新建的快捷方式要保留，删除的快捷方式不能再加回来"
+        changed, self.changedWhileLoading = self.changedWhileLoading, None
+        shortcuts = self.db.attachRowsShortcut([row for row in rows if row.id not in changed])
+        ids = set(shortcut.id for shortcut in shortcuts)
+        shortcuts.extend(shortcut for shortcut in self.shortcuts if shortcut.id not in ids)
+        self.beginResetModel()
+        self.shortcuts = shortcuts
+        self.endResetModel()
 
     def rowCount(self, parent):
         if not parent.isValid():
@@ -262,7 +277,8 @@ class QuickDesktopModel(QAbstractListModel):
             return False
         shortcut = self.shortcuts[index.row()]
         shortcut["name"] = value
-        shortcut.save()
+        shortcut.flush()
+        self.markChanged(shortcut)
         self.dataChanged.emit(index, index)
         return True
 
@@ -283,8 +299,13 @@ class QuickDesktopModel(QAbstractListModel):
         self.beginRemoveRows(QModelIndex(), index.row(), index.row())
         shortcut = self.shortcuts.pop(index.row())
         shortcut.deleteFromDatabase()
+        self.markChanged(shortcut)
         self.endRemoveRows()
 
+    def markChanged(self, shortcut):
+        if self.changedWhileLoading is not None:
+            self.changedWhileLoading.add(shortcut.id)
+
     def isSpecialShortcut(self, index):
         if not index.isValid():
             return False
@@ -344,9 +365,10 @@ class QuickDesktopModel(QAbstractListModel):
     def updateShortcut(self, shortcut, index):
         self.dataChanged.emit(index, index)
         oldone = self.shortcuts[index.row()]
-        for field in shortcut:
+        for field in list(shortcut.keys()):
             oldone[field] = shortcut[field]
-        oldone.save()
+        oldone.flush()
+        self.markChanged(oldone)
         del self.shortcuts[index.row()]["_icon"]
 
 
@@ -606,11 +628,16 @@ class Shortcut(Table):
 
 class ShortcutDatabase(Database):
     tables = (Shortcut, )
+    #编辑快捷方式时会逐个修改字段，积累起来调用flush()时一次写入
+    writeBehind = True
+    #桌面模型长期持有快捷方式，后台读取的结果要合并到同一个数据对象
+    identityMapSize = 256
 
     def createInitialData(self, table):
         if table is Shortcut:
+            shortcuts = []
             if os.name == "nt":
-                self.insertShortcut({
+                shortcuts.append({
                         "id": str(uuid.uuid4()),
                         "name": self.tr("我的电脑"),
                         "path": COMPUTER_PATH,
@@ -618,7 +645,7 @@ class ShortcutDatabase(Database):
                         "icon": "",
                         "dir": "",
                 })
-            self.insertShortcut({
+            shortcuts.append({
                     "id": str(uuid.uuid4()),
                     "name": self.tr("我的文档"),
                     "path": DOCUMENTS_PATH,
@@ -626,7 +653,7 @@ class ShortcutDatabase(Database):
                     "icon": "",
                     "dir": "",
             })
-            self.insertShortcut({
+            shortcuts.append({
                     "id": str(uuid.uuid4()),
                     "name": self.tr("我的音乐"),
                     "path": MUSIC_PATH,
@@ -634,7 +661,7 @@ class ShortcutDatabase(Database):
                     "icon": "",
                     "dir": "",
             })
-            self.insertShortcut({
+            shortcuts.append({
                     "id": str(uuid.uuid4()),
                     "name": self.tr("图片收藏"),
                     "path": PICTURES_PATH,
@@ -642,3 +669,4 @@ class ShortcutDatabase(Database):
                     "icon": "",
                     "dir": "",
             })
+            self.insertManyShortcut(shortcuts)
@@ -1,6 +1,6 @@
 import uuid
 from PyQt5.QtWidgets import QDialog, QMessageBox, QDialogButtonBox
-from besteam.utils.sql import Database, Table
+from besteam.utils.sql import Database, Table, Index
 from .Ui_todo_editor import Ui_SimpleTodoEditor
 
 __all__ = ["SimpleBackend"]
@@ -10,9 +10,13 @@ class SimpleTodo(Table):
             "finishment":"number",
             "subject":"text",
             }
+    #默认只显示未完成的待办事项。完成的待办事项会越积越多，所以只索引未完成的
+    indexes = [Index("finishment", where = "finishment < 100")]
 
 class SimpleTodoDatabas(Database):
     tables = (SimpleTodo, )
+    #列表模型长期持有待办事项，修改通知与重新读取都要刷新同一个数据对象
+    identityMapSize = 256
 
 class SimpleBackend:
     def __init__(self, databaseFile):
@@ -54,13 +58,41 @@ class SimpleBackend:
         task.deleteFromDatabase()
 
     def listTodo(self):
+        if self.showAll:
+            return self.db.selectSimpleTodo("")
+        #条件要与SimpleTodo.indexes里的部分索引一致，才能用上索引
+        return self.db.selectSimpleTodo("where finishment < 100")
+
+    def listTodoRows(self, showAll):
+        """与listTodo()一样，但是返回namedtuple，不创建数据对象，可以在后台线程里调用。
+        读取的结果要在界面线程里使用attachTodos()转换成数据对象。"""
+        if showAll:
+            return self.db.selectRowsSimpleTodo("")
+        return self.db.selectRowsSimpleTodo("where finishment < 100")
+
+    def attachTodos(self, rows, changedIds = None):
+        """把listTodoRows()读取的结果转换成数据对象，已经存在的数据对象会被刷新。
+        给出changedIds集合的话，新的以及内容有变化的待办事项的ID会被加入这个集合"""
+        return self.db.attachRowsSimpleTodo(rows, changedIds)
+
+    def isVisible(self, todo):
+        #与listTodo()的where finishment < 100一致，NULL在SQL里也不满足这个条件
+        return self.showAll or (todo["finishment"] is not None and todo["finishment"] < 100)
+
+    def getTodos(self, ids):
+        "按ID读取待办事项，已经被删除的会被忽略"
+        #批量插入的修改通知可能包含很多ID，每条语句最多使用inClauseSize个参数
+        ids = list(ids)
         todoList = []
-        for todo in self.db.selectSimpleTodo(""):
-            if not self.showAll and todo["finishment"] == 100:
-                continue
-            todoList.append(todo)
+        for start in range(0, len(ids), self.db.inClauseSize):
+            chunk = ids[start:start + self.db.inClauseSize]
+            todoList.extend(self.db.selectSimpleTodo("where id in (%s)" % ",".join("?" * len(chunk)), *chunk))
         return todoList
 
+    def watchTodo(self, callback):
+        "待办事项被添加、修改或者删除的时候调用callback(action, tableName, ids)"
+        self.db.subscribe(SimpleTodo.getName(), callback)
+
     def updateTaskById(self, taskId):
         #不需要刷新其它界面
         pass
@@ -1,7 +1,9 @@
+import functools
 from PyQt5.QtCore import QAbstractTableModel, QModelIndex, Qt, pyqtSignal
 from PyQt5.QtGui import QCursor
 from PyQt5.QtWidgets import QComboBox, QHeaderView, QMenu, QMessageBox, QStyledItemDelegate, \
         QWidget
+from besteam.utils.sql import databaseExecutor
 from .todo_backend import SimpleBackend
 from .Ui_todolist import Ui_TodoListWidget
 
@@ -23,6 +25,10 @@ class TodoListWidget(QWidget, Ui_TodoListWidget):
         self.backend = SimpleBackend(parent.window().platform.databaseFile)
         self.todoListModel = TodoListModel()
         self.todoListDelegate = TodoListDelegate()
+        #showEvent()在后台线程里读取待办事项。loadSerial用于丢弃过时的读取结果，
+        #changedWhileLoading是读取期间收到修改通知的待办事项，读取的结果里它们可能是旧的
+        self.loadSerial = 0
+        self.changedWhileLoading = None
         self.todoListModel.updateTodoList(self.backend.listTodo())
         self.tvTodoList.setModel(self.todoListModel)
         self.tvTodoList.header().setSectionResizeMode(QHeaderView.ResizeToContents)
@@ -42,15 +48,52 @@ class TodoListWidget(QWidget, Ui_TodoListWidget):
         self.btnAddTodo.clicked.connect(self.addTodoQuickly)
         self.todoListModel.taskUpdated.connect(self.backend.updateTaskById)
         self.chkShowAll.toggled.connect(self.setShowAll)
+        self.backend.watchTodo(self.onTodoChanged)
+
+    def onTodoChanged(self, action, tableName, ids):
+        "数据库里的待办事项被修改了，只更新变化的行"
+        if self.changedWhileLoading is not None:
+            if ids is None:
+                self.cancelLoading()
+            else:
+                self.changedWhileLoading.update(ids)
+        if ids is None:
+            self.todoListModel.updateTodoList(self.backend.listTodo())
+        elif action == "delete":
+            self.todoListModel.removeTodosById(ids)
+        else:
+            #已经显示的待办事项即使刚刚被标记为完成也先留着，下次显示的时候再隐藏
+            newTodos = self.todoListModel.refreshTodos(self.backend.getTodos(ids))
+            self.todoListModel.appendTodos([todo for todo in newTodos if self.backend.isVisible(todo)])
 
     def setShowAll(self, showAll):
+        self.cancelLoading()
         self.backend.setShowAll(showAll)
         self.todoListModel.updateTodoList(self.backend.listTodo())
 
     def showEvent(self, event):
-        self.todoListModel.updateTodoList(self.backend.listTodo())
+        #在后台线程里读取，读取完成以后再刷新变化的行，不耽误快捷面板弹出来
+        self.loadSerial += 1
+        self.changedWhileLoading = set()
+        databaseExecutor.submit(self.backend.listTodoRows, self.backend.showAll, \
+                callback = functools.partial(self.onTodoListLoaded, self.loadSerial))
         QWidget.showEvent(self, event)
 
+    def cancelLoading(self):
+        "已经在界面线程里重新读取了整个列表，丢弃后台线程正在读取的结果"
+        self.loadSerial += 1
+        self.changedWhileLoading = None
+
+    def onTodoListLoaded(self, loadSerial, rows):
+        if loadSerial != self.loadSerial:
+            return
+        changed, self.changedWhileLoading = self.changedWhileLoading, None
+        #读取期间修改过的待办事项已经由onTodoChanged()处理了，不能使用读取的旧数据
+        rows = [row for row in rows if row.id not in changed]
+        changedIds = set()
+        todoList = self.backend.attachTodos(rows, changedIds)
+        self.todoListModel.updateTodoList(todoList, keep = changed, changedIds = changedIds)
+
     def onTodoListContextMenuReqeusted(self, pos):
         index = self.tvTodoList.indexAt(pos)
         if index.isValid():
@@ -98,8 +141,8 @@ class TodoListWidget(QWidget, Ui_TodoListWidget):
         currentIndex = self.tvTodoList.currentIndex()
         if not currentIndex.isValid():
             return
+        #删除以后onTodoChanged()会把它从列表里移除
         self.backend.removeTodo(self.todoListModel.todoAt(currentIndex))
-        self.todoListModel.removeTodo(currentIndex)
 
     def modifyTodoSubject(self):
         currentIndex = self.tvTodoList.currentIndex()
@@ -203,21 +246,67 @@ class TodoListModel(QAbstractTableModel):
                 return self.tr("标题")
         return None
 
-    def updateTodoList(self, todoList):
-        "更新待办事项列表。当快捷面板被显示时，刷新列表内容。"
-        self.beginResetModel()
-        self.todoList = todoList
-        self.endResetModel()
+    def updateTodoList(self, todoList, keep = (), changedIds = None):
+        """更新待办事项列表。当快捷面板被显示时，刷新列表内容。
+        只移除、添加和刷新有变化的行，不重置整个模型，视图的当前行与滚动位置都能保留。
+        ID在keep里的待办事项即使不在todoList里也保留。changedIds是内容有变化的待办事项的ID，
+        只有这些行会引发dataChanged信号，为None时刷新所有的行。"""
+        ids = set(todo["id"] for todo in todoList)
+        self._removeRows(lambda todo: todo["id"] not in ids and todo["id"] not in keep)
+        self.appendTodos(self.refreshTodos(todoList, changedIds))
+
+    def refreshTodos(self, todoList, changedIds = None):
+        """刷新已经在列表里的待办事项，返回不在列表里的待办事项。
+        changedIds的意义与updateTodoList()一样。"""
+        rows = dict((todo["id"], row) for row, todo in enumerate(self.todoList))
+        newTodos = []
+        for todo in todoList:
+            row = rows.get(todo["id"])
+            if row is None:
+                newTodos.append(todo)
+                continue
+            self.todoList[row] = todo
+            if changedIds is None or todo["id"] in changedIds:
+                self.updateTodo(self.createIndex(row, 0))
+        return newTodos
+
+    def appendTodos(self, todoList):
+        "在列表末尾添加多个待办事项，调用者要保证它们不在列表里"
+        if not todoList:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.todoList), len(self.todoList) + len(todoList) - 1)
+        self.todoList.extend(todoList)
+        self.endInsertRows()
+
+    def _removeRows(self, predicate):
+        "移除所有使predicate(todo)为真的待办事项，连续的行一次移除"
+        row = len(self.todoList)
+        while row > 0:
+            row -= 1
+            if not predicate(self.todoList[row]):
+                continue
+            last = row
+            while row > 0 and predicate(self.todoList[row - 1]):
+                row -= 1
+            self.beginRemoveRows(QModelIndex(), row, last)
+            del self.todoList[row:last + 1]
+            self.endRemoveRows()
+
+    def findTodo(self, id):
+        "返回待办事项所在的行，没有的话返回None"
+        for row, todo in enumerate(self.todoList):
+            if todo["id"] == id:
+                return row
+        return None
+
+    def removeTodosById(self, ids):
+        ids = set(ids)
+        self._removeRows(lambda todo: todo["id"] in ids)
 
     def todoAt(self, index):
         assert index.isValid()
         return self.todoList[index.row()]
 
-    def removeTodo(self, index):
-        self.beginRemoveRows(QModelIndex(), index.row(), index.row())
-        self.todoList.pop(index.row())
-        self.endRemoveRows()
-
     def updateTodo(self, index):
         topLeft = self.createIndex(index.row(), 0)
         bottomRight = self.createIndex(index.row(), 1)
@@ -227,6 +316,10 @@ class TodoListModel(QAbstractTableModel):
         return self.todoList[index.row()]
 
     def appendTodo(self, task):
+        #修改通知可能已经把它加进来了
+        row = self.findTodo(task["id"])
+        if row is not None:
+            return self.createIndex(row, 0)
         self.beginInsertRows(QModelIndex(), len(self.todoList), len(self.todoList))
         self.todoList.append(task)
         self.endInsertRows()
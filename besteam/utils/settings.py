@@ -1,7 +1,17 @@
 from PyQt5.QtCore import QObject, QTimer
 
+import os
 import pickle
-from besteam.utils.sql import transaction, Table, Database
+import struct
+import zlib
+import functools
+import bisect
+import logging
+import types
+import weakref
+from besteam.utils.sql import Table, Database, databaseExecutor
+
+logger = logging.getLogger(__name__)
 
 class Preference(Table):
     pkName = "key"
@@ -11,11 +21,95 @@ class Preference(Table):
 class PreferenceDatabase(Database):
     tables = (Preference, )
 
+class SettingsJournal:
+    """只追加的修改日志，保证程序崩溃的时候最近的修改也不会丢失。
+    每条纪录是pickle过的(操作, 键, 数据)，前面加上长度与crc32。append()只把纪录放进内存，
+    takeBuffer()取出以后交给write()写入文件并fsync，这样可以一次fsync多条纪录。
+    _Settings把修改写入数据库以后使用rewrite()改写日志，只留下还没有写入数据库的修改。
+    程序启动的时候使用replay()读出日志里的纪录，最后一条纪录不完整的话(写到一半崩溃了)会被截掉。"""
+    header = struct.Struct(">II")
+
+    def __init__(self, path):
+        self.path = path
+        self.buffer = []
+
+    @classmethod
+    def encode(cls, op, key, raw):
+        payload = pickle.dumps((op, key, raw), 2)
+        return cls.header.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def append(self, op, key, raw):
+        "op是\"set\"或者\"remove\"，raw是pickle过的值"
+        self.buffer.append(self.encode(op, key, raw))
+
+    def takeBuffer(self):
+        data = b"".join(self.buffer)
+        self.buffer = []
+        return data
+
+    def write(self, data):
+        if not data:
+            return
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rewrite(self, data):
+        "使用data替换整个日志。先写入临时文件再改名，改写到一半崩溃的话旧的日志仍然完整。"
+        if not data:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.path)
+
+    def replay(self):
+        """返回日志里完整的(操作, 键, 数据)的列表。遇到不完整的纪录时把文件截断到最后一条完整的纪录，
+        否则以后追加的纪录都在坏掉的纪录后面，下次启动的时候就读不到了。"""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        records = []
+        pos = 0
+        while pos + self.header.size <= len(data):
+            length, crc = self.header.unpack_from(data, pos)
+            payload = data[pos + self.header.size:pos + self.header.size + length]
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            records.append(pickle.loads(payload))
+            pos += self.header.size + length
+        if pos < len(data):
+            logger.warning("truncate broken tail of settings journal %s", self.path)
+            with open(self.path, "r+b") as f:
+                f.truncate(pos)
+                f.flush()
+                os.fsync(f.fileno())
+        return records
+
+
 class _Settings(QObject):
+    """保存所有的用户配置。preferences是以全路径为键的dict，sortedKeys是排好序的键，
+    用于快速找出某个路径下的键，参见getPreferenceKeysWithPrefix()。
+    修改过的键记录在dirtyKeys里，删除的键记录在removedKeys里，最后一次修改saveDelay毫秒以后在后台写入数据库。
+    每次修改同时追加到SettingsJournal，journalDelay毫秒以后一起写入日志文件并fsync。
+    启动的时候先读取数据库，再重放日志里还没有写入数据库的修改。
+    启动的时候只读取pickle数据，第一次getPreference()的时候才解码。
+    watch()登记的函数在值真正改变的时候被调用。"""
     class Item:
         key = None
         value = None
-        dirty = False
+        raw = None #尚未解码的pickle数据，解码以后为None
+        pickled = None #最近一次写入日志或者数据库的pickle数据，用于判断值有没有改变
+
+    saveDelay = 1000
+    journalDelay = 200
 
     def __init__(self, db):
         super(_Settings, self).__init__()
@@ -23,73 +117,233 @@ class _Settings(QObject):
             self.db = db
         else:
             self.db = PreferenceDatabase(db)
-        self.preferences = []
-        for row in self.db.selectPreference(""):
+        self.preferences = {}
+        for row in self.db.iterRowsPreference(""):
             item = _Settings.Item()
-            item.key = row["key"]
-            item.value = pickle.loads(row["value"])
-            self.preferences.append(item)
+            item.key = row.key
+            item.raw = item.pickled = row.value
+            self.preferences[item.key] = item
+        self.watchers = {}
+        self.dirtyKeys = set()
+        self.removedKeys = set()
+        self.journal = SettingsJournal(self.db.dbfile + "-settings.journal")
+        for op, key, raw in self.journal.replay():
+            if op == "set":
+                item = self.preferences.get(key)
+                if item is None:
+                    item = self.preferences[key] = _Settings.Item()
+                    item.key = key
+                item.value, item.raw, item.pickled = None, raw, raw
+                self.dirtyKeys.add(key)
+                self.removedKeys.discard(key)
+            elif op == "remove":
+                self.preferences.pop(key, None)
+                self.dirtyKeys.discard(key)
+                self.removedKeys.add(key)
+        self.sortedKeys = sorted(self.preferences)
         if QTimer:
+            #连续修改的时候不断推迟，修改停下来以后才保存一次
             self.autoSaveTimer = QTimer()
-            self.autoSaveTimer.timeout.connect(self.save)
-            self.autoSaveTimer.start(5000)
+            self.autoSaveTimer.setSingleShot(True)
+            self.autoSaveTimer.setInterval(self.saveDelay)
+            self.autoSaveTimer.timeout.connect(self.saveLater)
+            self.journalTimer = QTimer()
+            self.journalTimer.setSingleShot(True)
+            self.journalTimer.setInterval(self.journalDelay)
+            self.journalTimer.timeout.connect(self.flushJournal)
+        else:
+            self.autoSaveTimer = None
+            self.journalTimer = None
+        if self.dirtyKeys or self.removedKeys:
+            self.save()
 
     def __del__(self):
         self.save()
 
     def contains(self, key):
-        for item in self.preferences:
-            if item.key == key:
-                return True
-        return False
+        return key in self.preferences
 
     def getPreference(self, key):
-        for item in self.preferences:
-            if item.key == key:
-                return item.value
-        raise KeyError()
+        item = self.preferences[key]
+        if item.raw is not None:
+            item.value = pickle.loads(item.raw)
+            item.raw = None
+        return item.value
 
     def setPreference(self, key, value):
-        for item in self.preferences:
-            if item.key == key:
-                item.value = value
-                item.dirty = True
-                return True
-        item = _Settings.Item()
-        item.key = key
+        pickled = pickle.dumps(value, 2)
+        item = self.preferences.get(key)
+        if item is None:
+            item = _Settings.Item()
+            item.key = key
+            self.preferences[key] = item
+            bisect.insort(self.sortedKeys, key)
+        elif item.pickled == pickled:
+            #值没有改变，不需要保存，也不需要通知
+            item.value = value
+            item.raw = None
+            return True
         item.value = value
-        item.dirty = True
-        self.preferences.append(item)
+        item.raw = None
+        item.pickled = pickled
+        self.dirtyKeys.add(key)
+        self.removedKeys.discard(key)
+        self.journal.append("set", key, pickled)
+        self._changed()
+        self._notify(key, value)
         return True
 
+    def watch(self, path, callback):
+        """path是全路径的键名，或者以"/"结尾的路径(包括子路径下的所有键)。
+        键的值改变或者被删除的时候调用callback(key, value)，key是全路径，删除的时候value为None。
+        绑定方法使用弱引用保存，对象被销毁以后自动取消。"""
+        if isinstance(callback, types.MethodType):
+            ref = weakref.WeakMethod(callback)
+        else:
+            ref = lambda: callback
+        self.watchers.setdefault(path, []).append(ref)
+
+    def unwatch(self, path, callback):
+        refs = self.watchers.get(path, [])
+        refs[:] = [ref for ref in refs if ref() is not None and ref() != callback]
+
+    def _notify(self, key, value):
+        if not self.watchers:
+            return
+        #依次检查键本身与它所在的每一级路径
+        paths = [key]
+        pos = key.find("/")
+        while pos >= 0:
+            paths.append(key[:pos + 1])
+            pos = key.find("/", pos + 1)
+        for path in paths:
+            refs = self.watchers.get(path)
+            if not refs:
+                continue
+            refs[:] = [ref for ref in refs if ref() is not None]
+            for ref in list(refs):
+                callback = ref()
+                if callback is None:
+                    continue
+                try:
+                    callback(key, value)
+                except Exception:
+                    logger.exception("settings watcher for %s failed", path)
+
     def getPreferenceKeysWithPrefix(self, prefix):
         #XXX 是否包含子目录的键值呢？对照QSettings，应该是不包含的
         assert prefix.endswith("/")
         keys = []
-        for item in self.preferences:
-            if item.key.startswith(prefix):
-                name = item.key[len(prefix):]
-                if "/" not in name:
-                    keys.append(name)
+        sortedKeys = self.sortedKeys
+        i = bisect.bisect_left(sortedKeys, prefix)
+        while i < len(sortedKeys) and sortedKeys[i].startswith(prefix):
+            name = sortedKeys[i][len(prefix):]
+            if "/" not in name:
+                keys.append(name)
+                i += 1
+            else:
+                #跳过整个子目录。"0"是排在"/"后面的第一个字符
+                subdir = prefix + name[:name.index("/")]
+                i = bisect.bisect_left(sortedKeys, subdir + "0", i)
         return keys
 
-    @transaction
     def removePreference(self, key):
-        for item in self.preferences:
-            if item.key == key:
-                self.preferences.remove(item)
-                self.db.deletePreference("where key=?", key)
-                return
-        raise KeyError()
-
-    @transaction
+        if key not in self.preferences:
+            raise KeyError()
+        del self.preferences[key]
+        del self.sortedKeys[bisect.bisect_left(self.sortedKeys, key)]
+        self.dirtyKeys.discard(key)
+        self.removedKeys.add(key)
+        self.journal.append("remove", key, None)
+        self._changed()
+        self._notify(key, None)
+
+    def _changed(self):
+        if self.autoSaveTimer is None:
+            self.journal.write(self.journal.takeBuffer())
+            return
+        self.autoSaveTimer.start()
+        if not self.journalTimer.isActive():
+            self.journalTimer.start()
+
+    def flushJournal(self):
+        "把积累的修改写入日志文件。在databaseExecutor的后台线程里fsync，与写入数据库的操作按顺序执行。"
+        data = self.journal.takeBuffer()
+        if data:
+            databaseExecutor.submit(self.journal.write, data)
+
     def save(self):
-        for item in self.preferences:
-            if not item.dirty:
-                continue
-            self.db.deletePreference("where key=?", item.key)
-            self.db.insertPreference({"key":item.key, "value":pickle.dumps(item.value, 2)})
-            item.dirty = False
+        "把修改过的设置写入数据库，等待写入完成。没有修改的时候什么都不做。"
+        if not self.dirtyKeys and not self.removedKeys:
+            return
+        #先把缓冲区里的修改写入日志，写入数据库失败的话日志里仍然有这些修改
+        data = self.journal.takeBuffer()
+        try:
+            databaseExecutor.run(self.journal.write, data)
+        except Exception:
+            self.journal.buffer.insert(0, data)
+            raise
+        changes, removed = self._takeChanges()
+        try:
+            databaseExecutor.run(self._write, changes, removed)
+        except Exception as e:
+            self._restoreChanges(changes, removed, e)
+            raise
+        databaseExecutor.run(self.journal.rewrite, self._pendingJournal())
+
+    def saveLater(self):
+        "延迟保存使用的函数。在databaseExecutor的后台线程里写入数据库，不阻塞界面。"
+        if not self.dirtyKeys and not self.removedKeys:
+            return
+        changes, removed = self._takeChanges()
+        databaseExecutor.submit(self._write, changes, removed, callback = self._compactJournal, \
+                errback = functools.partial(self._restoreChanges, changes, removed))
+
+    def _takeChanges(self):
+        "在当前线程里序列化修改过的设置，返回(键, 数据)的列表与删除的键。后台线程只接触这两个列表。"
+        changes = []
+        for key in self.dirtyKeys:
+            item = self.preferences[key]
+            if item.raw is None:
+                #保存的时候重新序列化，调用setPreference()以后直接修改了值的情况也能保存下来
+                item.pickled = pickle.dumps(item.value, 2)
+            changes.append((key, item.pickled))
+        removed = list(self.removedKeys)
+        self.dirtyKeys = set()
+        self.removedKeys = set()
+        return changes, removed
+
+    def _write(self, changes, removed):
+        if changes:
+            self.db.upsertManyPreference([{"key":key, "value":value} for key, value in changes])
+        if removed:
+            self.db.deleteManyPreference(removed)
+
+    def _pendingJournal(self):
+        "还没有写入数据库的修改，改写日志的时候使用"
+        data = []
+        for key in self.dirtyKeys:
+            data.append(SettingsJournal.encode("set", key, pickle.dumps(self.getPreference(key), 2)))
+        for key in self.removedKeys:
+            data.append(SettingsJournal.encode("remove", key, None))
+        return b"".join(data)
+
+    def _compactJournal(self, result):
+        "修改写入数据库以后，日志里只需要留下这段时间新的修改"
+        self.journal.takeBuffer()
+        databaseExecutor.submit(self.journal.rewrite, self._pendingJournal())
+
+    def _restoreChanges(self, changes, removed, exception):
+        "后台保存失败的时候调用，saveDelay毫秒以后再试。日志里的纪录还在，不需要修改。"
+        logger.error("can not save preferences", exc_info = exception)
+        for key, value in changes:
+            if key in self.preferences:
+                self.dirtyKeys.add(key)
+        for key in removed:
+            if key not in self.preferences:
+                self.removedKeys.add(key)
+        if self.autoSaveTimer is not None:
+            self.autoSaveTimer.start()
 
 class Settings:
     """供各个模块存储用户使用偏好，比如窗口大小，显示的字段等数据。
@@ -151,6 +405,14 @@ class Settings:
         key = self._prefix() + k
         return self._settings.contains(key)
 
+    def watch(self, k, callback):
+        """值改变的时候调用callback(key, value)，key是全路径，删除的时候value为None。
+        k是当前路径下的键名，或者以"/"结尾的子路径，k为""的时候监视当前路径。参见_Settings.watch()"""
+        self._settings.watch(self._prefix() + k, callback)
+
+    def unwatch(self, k, callback):
+        self._settings.unwatch(self._prefix() + k, callback)
+
     def remove(self, k):
         key = self._prefix() + k
         try:
@@ -1,4 +1,3 @@
-import os
 import sqlite3
 import threading
 import pickle
@@ -8,14 +7,26 @@ import sys
 import warnings
 import logging
 import functools
+import collections
+import json
+import weakref
+import concurrent.futures
+import time
+import bisect
+import itertools
 try:
-    from PyQt5.QtCore import QDate, QDateTime, QObject
+    from PyQt5.QtCore import QDate, QDateTime, QObject, pyqtSignal
     usingPyQt5 = True
 except ImportError:
     usingPyQt5 = False
+try:
+    import msgpack
+    usingMsgpack = True
+except ImportError:
+    usingMsgpack = False
 
-__all__ = ["Table", "Database", "DatabaseException", "transaction", "DataObject",
-    "DataObjectProxy", "createDataObject", "createDetachedDataObject"]
+__all__ = ["Table", "Database", "DatabaseException", "transaction", "retryOnBusy", "DataObject",
+    "DataObjectProxy", "createDataObject", "createDetachedDataObject", "ChangeNotifier", "Index", "DatabaseExecutor", "databaseExecutor", "queryLog"]
 
 #是否打印调试信息，如果为真，会打印出所有执行的SQL语句
 sql_debug = False
@@ -75,6 +86,82 @@ class DictProxy:
     def __contains__(self, k):
         return k in self.__target
 
+class ColumnCodec:
+    """把字段的值编码成blob保存。Table.columns中字段类型写成"json"或者"msgpack"的字段会使用对应的编码器，
+    这样就不用pickle保存list与dict了，解码更快，也可以在SQL中查询。
+    编码后的blob以一个标记字节与一个版本字节开头。解码的时候如果发现是旧的pickle数据，
+    会使用pickle_loads()解码，所以字段类型改成json以后，旧数据仍然可以读取，也可以慢慢迁移。"""
+    tag = None
+    version = 1
+
+    def dumps(self, o):
+        raise NotImplementedError()
+
+    def loads(self, s, version):
+        raise NotImplementedError()
+
+    def encode(self, o):
+        if o is None:
+            return None
+        return self.tag + bytes((self.version, )) + self.dumps(o)
+
+    def decode(self, s):
+        if s is None:
+            return None
+        s = bytes(s)
+        if s[:1] == self.tag:
+            return self.loads(s[2:], s[1])
+        if isPickled(s):
+            return pickle_loads(s)
+        raise DatabaseException("unknown column format: %r" % s[:2])
+
+    def isEncoded(self, s):
+        return s is not None and bytes(s[:1]) == self.tag
+
+
+class JsonCodec(ColumnCodec):
+    tag = b"J"
+
+    def dumps(self, o):
+        return json.dumps(o, ensure_ascii = False, separators = (",", ":")).encode("utf-8")
+
+    def loads(self, s, version):
+        return json.loads(s.decode("utf-8"))
+
+
+class MsgpackCodec(ColumnCodec):
+    tag = b"M"
+
+    def dumps(self, o):
+        return msgpack.packb(o, use_bin_type = True)
+
+    def loads(self, s, version):
+        return msgpack.unpackb(s, raw = False)
+
+
+def isSameValue(a, b):
+    "比较两个值是否完全一样，包括容器里面每个元素的类型。用于检查编码以后能不能原样解码"
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(isSameValue(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        if len(a) != len(b):
+            return False
+        #1与1.0、True是相等的键，要用b自己的键对象比较类型
+        keys = dict((k, k) for k in b)
+        return all(k in keys and type(k) is type(keys[k]) and isSameValue(v, b[k]) for k, v in a.items())
+    return a == b
+
+def isPickled(s):
+    "第2版以后的pickle协议生成的数据都以b'\\x80'开头，后面跟着协议版本号"
+    return s[:1] == b"\x80"
+
+#字段类型与编码器的对应关系。没有安装msgpack的时候不能使用msgpack类型。
+columnCodecs = {"json": JsonCodec()}
+if usingMsgpack:
+    columnCodecs["msgpack"] = MsgpackCodec()
+
 def classNameToSqlName(className):
     """把表格的类名转换成表格的SQL表名。如`ClassName`到`class_name`"""
     return className[0].lower() + "".join(
@@ -112,26 +199,374 @@ sqlite3.register_converter("bool", convert_bool)
 sqlite3.register_converter("list", pickle.loads)
 sqlite3.register_converter("dict", pickle.loads)
 
+class _Connection(sqlite3.Connection):
+    "连接池里的连接。记住自己属于连接池的哪个分组，归还到连接池的时候要用到。"
+    poolKey = None
+
+
+class ConnectionPool:
+    """为每个线程、每个数据库文件保留几个长期打开的sqlite3连接，省去每次查询都要重新打开数据库的开销。
+    sqlite3的连接对象不能跨线程使用，所以连接是按线程分开存放的。
+    acquire()取出一个空闲的连接，没有空闲连接就新建一个。release()把连接放回连接池，
+    空闲连接超过maxSize个的时候多余的连接会被关闭。
+    新建连接的时候会执行一遍pragmas指定的PRAGMA语句，PRAGMA不同的连接分开存放。"""
+
+    #每个连接里sqlite3模块缓存的预编译语句数量
+    cachedStatements = 256
+
+    def __init__(self, maxSize = 4):
+        self.maxSize = maxSize
+        self.local = threading.local()
+
+    def _pools(self):
+        try:
+            return self.local.pools
+        except AttributeError:
+            pools = self.local.pools = {}
+            return pools
+
+    def _idleConnections(self, poolKey):
+        pools = self._pools()
+        try:
+            return pools[poolKey]
+        except KeyError:
+            idle = pools[poolKey] = []
+            return idle
+
+    def acquire(self, dbfile, pragmas = ()):
+        "取出一个连接。pragmas是(名字, 值)的tuple，只在新建连接的时候执行。"
+        idle = self._idleConnections((dbfile, pragmas))
+        while idle:
+            conn = idle.pop()
+            if self.check(conn):
+                return conn
+            self.discard(conn)
+        return self.connect(dbfile, pragmas)
+
+    def release(self, conn):
+        idle = self._idleConnections(conn.poolKey)
+        if len(idle) < self.maxSize and self.check(conn):
+            idle.append(conn)
+        else:
+            self.discard(conn)
+
+    def connect(self, dbfile, pragmas = ()):
+        conn = sqlite3.connect(dbfile, detect_types = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, \
+                factory = _Connection, cached_statements = self.cachedStatements)
+        conn.poolKey = (dbfile, pragmas)
+        conn.row_factory = sqlite3.Row
+        for name, value in pragmas:
+            sql = "PRAGMA %s=%s;" % (name, value)
+            if sql_debug:
+                print(sql)
+            try:
+                conn.execute(sql).fetchall()
+            except sqlite3.Error:
+                #比如只读的文件不能切换到WAL模式。PRAGMA只是优化，失败了也可以继续使用这个连接
+                logger.warning("can not execute %s on %s", sql, dbfile, exc_info = True)
+        return conn
+
+    def check(self, conn):
+        "检查连接是否还能使用。连接上残留的事务会被回滚掉。"
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self, dbfile):
+        "关闭当前线程中属于dbfile的所有空闲连接。"
+        for (file, pragmas), idle in self._pools().items():
+            if file != dbfile:
+                continue
+            while idle:
+                self.discard(idle.pop())
+
+connectionPool = ConnectionPool()
+
+
+class StatementCache:
+    """缓存Database.select()/insert()/update()等函数拼接好的SQL语句。
+    键是(操作, 表名, 字段, where子句)这样的元组。因为每次拿到的都是同一个字符串，
+    sqlite3模块也能直接命中它自己的预编译语句缓存。
+    缓存的语句超过maxSize条时全部清空，通常where子句都是写死在代码里的，不会太多。"""
+
+    def __init__(self, maxSize = 512):
+        self.maxSize = maxSize
+        self.statements = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            statement = self.statements[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return statement
+
+    def put(self, key, statement):
+        if len(self.statements) >= self.maxSize:
+            self.statements.clear()
+        self.statements[key] = statement
+        return statement
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.statements)}
+
+statementCache = StatementCache()
+
+def joinSql(head, sql):
+    "把select/update/delete语句的前半部分与调用者传入的where子句连接起来。"
+    if sql != "":
+        return head + " " + sql + ";"
+    return head + ";"
+
+class ChangeNotifier:
+    """数据库的修改通知。按(数据库文件, 表名)登记回调函数，修改数据以后调用
+    callback(action, tableName, ids)。action是"insert"、"update"或者"delete"，
+    ids是被修改的纪录的主键列表。不能确定修改了哪些纪录的时候(比如使用任意where子句的update)，
+    ids为None，这时订阅者应该重新读取整个表格。
+    在事务中的修改等到事务提交以后才通知，回滚的事务不通知。通知在修改数据的线程里调用。
+    绑定方法使用弱引用保存，对象被销毁以后自动取消订阅。"""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, dbfile, tableName, callback):
+        if isinstance(callback, types.MethodType):
+            ref = weakref.WeakMethod(callback)
+        else:
+            ref = lambda: callback
+        with self.lock:
+            self.subscribers.setdefault((dbfile, tableName), []).append(ref)
+
+    def unsubscribe(self, dbfile, tableName, callback):
+        with self.lock:
+            refs = self.subscribers.get((dbfile, tableName), [])
+            refs[:] = [ref for ref in refs if ref() is not None and ref() != callback]
+
+    def hasSubscribers(self, dbfile, tableName):
+        return bool(self.subscribers.get((dbfile, tableName)))
+
+    def notify(self, dbfile, tableName, action, ids):
+        "登记一个修改。没有订阅者时什么都不做，所以不订阅的话几乎没有额外开销。"
+        if not self.hasSubscribers(dbfile, tableName):
+            return
+        if hasattr(transaction_local, "transaction"):
+            changes = transaction_local.changes
+            #同一个事务里连续的同类修改合并成一个通知
+            if changes and ids is not None and changes[-1][:3] == (dbfile, tableName, action) \
+                    and changes[-1][3] is not None:
+                changes[-1][3].extend(ids)
+            else:
+                changes.append((dbfile, tableName, action, None if ids is None else list(ids)))
+        else:
+            self.deliver([(dbfile, tableName, action, ids)])
+
+    def deliver(self, changes):
+        for dbfile, tableName, action, ids in changes:
+            with self.lock:
+                refs = self.subscribers.get((dbfile, tableName), [])
+                refs[:] = [ref for ref in refs if ref() is not None]
+                callbacks = [ref() for ref in refs]
+            for callback in callbacks:
+                try:
+                    callback(action, tableName, ids)
+                except Exception:
+                    logger.exception("change notification for %s failed", tableName)
+
+changeNotifier = ChangeNotifier()
+
+#这个进程里已经初始化过表格与索引的(数据库文件, Database子类)。参见Database.__init__()
+bootstrappedDatabases = set()
+
+QueryRecord = collections.namedtuple("QueryRecord", ["tableName", "method", "statement", "elapsed", "rows", "transactionId"])
+
+class QueryLog:
+    """统计每条SQL语句的执行时间。enabled为假时不做任何统计，只有sql_debug为真时打印语句。
+    每执行一条语句生成一个QueryRecord，包括表名、调用的方法(select、update等)、语句、执行时间(秒)、
+    返回或者修改的纪录数(不知道的时候为None)与事务编号(不在事务中为None)。
+    QueryRecord被交给addSink()登记的函数。执行时间超过slowQueryThreshold秒的语句使用logger.warning记录。
+    同时按(表名, 方法)汇总成直方图，使用dump()查看哪些查询最花时间。"""
+
+    #直方图每个区间的上限，单位是毫秒
+    bucketBounds = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+    def __init__(self):
+        self.enabled = False
+        self.slowQueryThreshold = 0.1
+        self.sinks = []
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+
+    def removeSink(self, sink):
+        self.sinks.remove(sink)
+
+    def record(self, tableName, method, statement, elapsed, rows):
+        record = QueryRecord(tableName, method, statement, elapsed, rows, getattr(transaction_local, "transactionId", None))
+        milliseconds = elapsed * 1000
+        with self.lock:
+            histogram = self.histograms.get((tableName, method))
+            if histogram is None:
+                histogram = self.histograms[(tableName, method)] = \
+                        {"count": 0, "total": 0.0, "max": 0.0, "rows": 0, "buckets": [0] * (len(self.bucketBounds) + 1)}
+            histogram["count"] += 1
+            histogram["total"] += milliseconds
+            histogram["max"] = max(histogram["max"], milliseconds)
+            if rows is not None and rows > 0:
+                histogram["rows"] += rows
+            histogram["buckets"][bisect.bisect_left(self.bucketBounds, milliseconds)] += 1
+        if elapsed >= self.slowQueryThreshold:
+            logger.warning("slow query (%.1fms, %s rows) on %s.%s: %s", milliseconds, rows, tableName, method, statement)
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%.3fms %s.%s: %s", milliseconds, tableName, method, statement)
+        for sink in self.sinks:
+            try:
+                sink(record)
+            except Exception:
+                logger.exception("query sink failed")
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def dump(self):
+        "返回直方图的文本，按总时间从多到少排列。"
+        lines = ["%-24s %-12s %8s %10s %8s %8s %8s  %s" % ("table", "method", "count", "total(ms)", "avg(ms)", \
+                "max(ms)", "rows", " ".join("<%g" % bound for bound in self.bucketBounds) + " more")]
+        with self.lock:
+            items = sorted(self.histograms.items(), key = lambda item: item[1]["total"], reverse = True)
+            for (tableName, method), histogram in items:
+                lines.append("%-24s %-12s %8d %10.2f %8.3f %8.3f %8d  %s" % (tableName, method, histogram["count"], \
+                        histogram["total"], histogram["total"] / histogram["count"], histogram["max"], histogram["rows"], \
+                        " ".join(str(count) for count in histogram["buckets"])))
+        return "\n".join(lines)
+
+queryLog = QueryLog()
+
+def executeStatement(cursor, statement, parameters, tableName, method, fetch = None, many = False):
+    """执行一条SQL语句，DataObject与Database的数据操作都使用这个函数执行SQL语句。
+    fetch是读取结果的函数，参数是cursor，它的返回值就是这个函数的返回值，读取结果的时间也算在执行时间内。
+    many为真时使用executemany()。参见QueryLog"""
+    if sql_debug:
+        print(statement, repr(parameters))
+    if not queryLog.enabled:
+        if many:
+            cursor.executemany(statement, parameters)
+        else:
+            cursor.execute(statement, parameters)
+        if fetch is not None:
+            return fetch(cursor)
+        return None
+    start = time.perf_counter()
+    if many:
+        cursor.executemany(statement, parameters)
+    else:
+        cursor.execute(statement, parameters)
+    result = None
+    if fetch is not None:
+        result = fetch(cursor)
+        rows = len(result) if hasattr(result, "__len__") else None
+    else:
+        rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    queryLog.record(tableName, method, statement, time.perf_counter() - start, rows)
+    return result
+
 transaction_local = threading.local()
+transactionIds = itertools.count(1)
 __transaction_debug = False
 
+def runBeforeTransactionEnd(committing):
+    """依次调用当前事务登记的回调函数。在事务提交或者回滚之前调用。
+    beforeCommit内的函数只在提交之前调用，beforeEnd内的函数在提交或者回滚之前都会调用。"""
+    if committing:
+        callbacks = transaction_local.beforeCommit
+        while callbacks:
+            callbacks.pop(0)()
+    callbacks = transaction_local.beforeEnd
+    while callbacks:
+        callbacks.pop(0)()
+
+savepointIds = itertools.count(1)
+
+def runSavepoint(wrapped, l, d):
+    """在已经存在的事务中执行嵌套的@transaction函数。函数出错的时候使用ROLLBACK TO撤销它自己做的修改，
+    外层的修改不受影响。如果外层捕获了这个异常，事务可以继续执行。
+    事务的连接还没有打开的话不需要保存点，出错的时候回滚整个事务就是撤销这个函数做的修改。"""
+    conn = transaction_local.conn
+    savepoint = None
+    if conn is not None:
+        #连接处于自动提交状态的时候，SAVEPOINT会自己开始一个事务，RELEASE的时候就提交了，所以先BEGIN
+        if not conn.in_transaction:
+            conn.execute("begin;")
+        savepoint = "sp%d" % next(savepointIds)
+        conn.execute("savepoint %s;" % savepoint)
+    changes = len(transaction_local.changes)
+    try:
+        result = wrapped(*l, **d)
+    except:
+        try:
+            if savepoint is not None:
+                conn.execute("rollback to %s;" % savepoint)
+                conn.execute("release %s;" % savepoint)
+            elif transaction_local.conn is not None and transaction_local.conn.in_transaction:
+                transaction_local.conn.rollback()
+            del transaction_local.changes[changes:]
+        except:
+            if __debug__:
+                traceback.print_exc()
+        raise
+    if savepoint is not None:
+        conn.execute("release %s;" % savepoint)
+    return result
+
 def transaction(wrapped):
-    "标注某个函数是形成一个事务，可以嵌套，但是不形成子事务。"
+    """标注某个函数是形成一个事务。可以嵌套，嵌套的函数使用SAVEPOINT形成子事务，
+    子事务出错的时候只撤销子事务的修改，参见runSavepoint()。"""
     def wrapper(*l, **d):
         passed = False
+        changes = None
         try:
-            if hasattr(transaction_local, "transaction") or __transaction_debug:
+            if __transaction_debug:
                 passed = True
+            elif hasattr(transaction_local, "transaction"):
+                passed = True
+                return runSavepoint(wrapped, l, d)
             else:
                 transaction_local.transaction = True
+                transaction_local.transactionId = next(transactionIds)
                 transaction_local.conn = None
+                #在事务提交或者回滚之前要调用的函数，比如让Database.iterSelect()把剩下的数据读进内存
+                transaction_local.beforeEnd = []
+                #在事务提交之前要调用的函数，比如把write-behind模式的数据对象写入数据库
+                transaction_local.beforeCommit = []
+                #事务提交以后才发出的修改通知，参见ChangeNotifier
+                transaction_local.changes = []
             result = wrapped(*l, **d)
-            if not passed and transaction_local.conn is not None:
-                transaction_local.conn.commit()
+            if not passed:
+                #数据对象在提交之前写入数据库时才会打开连接，所以这里不检查transaction_local.conn
+                runBeforeTransactionEnd(True)
+                if transaction_local.conn is not None:
+                    transaction_local.conn.commit()
+                changes = transaction_local.changes
             return result
         except:
             if not passed and transaction_local.conn is not None:
                 try:
+                    runBeforeTransactionEnd(False)
                     transaction_local.conn.rollback()
                 except:
                     if __debug__:
@@ -139,11 +574,128 @@ def transaction(wrapped):
             raise
         finally:
             if not passed:
+                conn = transaction_local.conn
                 del transaction_local.transaction
+                del transaction_local.transactionId
                 del transaction_local.conn
+                del transaction_local.beforeEnd
+                del transaction_local.beforeCommit
+                del transaction_local.changes
+                if conn is not None:
+                    connectionPool.release(conn)
+                if changes:
+                    changeNotifier.deliver(changes)
     functools.update_wrapper(wrapper, wrapped)
     return wrapper
 
+def isBusyError(e):
+    "数据库被其它连接锁住的错误。Database的访问函数会把sqlite3的异常包装成DatabaseException"
+    if not isinstance(e, (sqlite3.OperationalError, DatabaseException)):
+        return False
+    message = str(e).lower()
+    return "locked" in message or "busy" in message
+
+def retryOnBusy(wrapped = None, retries = 5, delay = 0.05, backoff = 2):
+    """遇到database is locked错误的时候等待一会儿再重新执行函数，每次等待的时间乘以backoff，
+    最多重试retries次。可以写成@retryOnBusy或者@retryOnBusy(retries = 10)。
+    只有最外层的事务才能重试，在事务中调用的时候直接执行，出错了由外层处理。
+    被重试的函数应该自己形成一个事务(使用@transaction)，否则前面已经自动提交的修改会再做一遍。"""
+    if wrapped is None:
+        return functools.partial(retryOnBusy, retries = retries, delay = delay, backoff = backoff)
+    def wrapper(*l, **d):
+        if hasattr(transaction_local, "transaction"):
+            return wrapped(*l, **d)
+        wait = delay
+        for i in range(retries):
+            try:
+                return wrapped(*l, **d)
+            except Exception as e:
+                if not isBusyError(e):
+                    raise
+                logger.info("database is busy, retry %s in %.2fs", getattr(wrapped, "__name__", wrapped), wait)
+            time.sleep(wait)
+            wait *= backoff
+        return wrapped(*l, **d)
+    functools.update_wrapper(wrapper, wrapped)
+    return wrapper
+
+
+class IdentityMap:
+    """以(表名, 主键)为键保存数据对象的弱引用，保证同一条纪录只对应一个DataObject。
+    最近使用过的maxSize个数据对象另外使用强引用保存，即使调用者暂时不再引用它们，
+    下次select的时候仍然可以直接使用。hits与misses纪录命中与未命中的次数。"""
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.objects = weakref.WeakValueDictionary()
+        self.recent = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            dataObject = self.objects.get(key)
+            if dataObject is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(key, dataObject)
+            return dataObject
+
+    def peek(self, key):
+        "与get()一样，但是不计入命中次数，也不改变最近使用的顺序。写入数据库的时候刷新数据对象使用"
+        with self.lock:
+            return self.objects.get(key)
+
+    def attachMany(self, keys, create, refresh):
+        """select()使用的批量查找，整批纪录只加锁一次。keys是(表名, 主键)的列表，
+        没有数据对象的键调用create(i)创建并放进来，已经有的调用refresh(i, dataObject)刷新。返回数据对象的列表。"""
+        objects = self.objects
+        dataObjects = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                dataObject = objects.get(key)
+                if dataObject is None or dataObject.detached:
+                    self.misses += 1
+                    dataObject = create(i)
+                    objects[key] = dataObject
+                else:
+                    self.hits += 1
+                    refresh(i, dataObject)
+                self._touch(key, dataObject)
+                dataObjects.append(dataObject)
+        return dataObjects
+
+    def put(self, key, dataObject):
+        with self.lock:
+            self.objects[key] = dataObject
+            self._touch(key, dataObject)
+
+    def remove(self, key):
+        with self.lock:
+            self.objects.pop(key, None)
+            self.recent.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.objects.clear()
+            self.recent.clear()
+
+    def _touch(self, key, dataObject):
+        if self.maxSize <= 0:
+            return
+        recent = self.recent
+        recent[key] = dataObject
+        recent.move_to_end(key)
+        if len(recent) > self.maxSize:
+            recent.popitem(last = False)
+
+    def info(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.objects),
+                "hitRate": float(self.hits) / total if total else 0.0}
+
 
 class DatabaseException(Exception):
     pass
@@ -154,8 +706,8 @@ class InvalidTableException(DatabaseException):
 
 
 #DataObject是一个简单的东西。它并不能处理关系映射之类的东西。它不是什么ORM。
-#TODO 通过Database.update()语句更新数据库时没有判断数据对象需不需要更新。
-#这种情况可能会产生一些不一致现象。现在的原则是，使用数据对象就不使用update()
+#TODO 按主键更新或者删除的时候会刷新IdentityMap里的数据对象，但是使用其它where子句调用
+#Database.update()时不知道修改了哪些纪录，数据对象不会更新。现在的原则是，使用数据对象就不使用这种update()
 class DataObject(DictProxy):
     """数据对象用于存取数据库记录，它的使用形式类似于Python内置的dict类型。
     DataObject本质是一个容纳数据库记录的缓存，但是可以设定某个字段不读取到内存中。
@@ -168,12 +720,15 @@ class DataObject(DictProxy):
     DataObject.db 数据对象所属的Database
     DataObject.detached 数据对象是否处于分离状态
     DataObject.notInMemory 这个是一个列表，用于指明哪些字段不处于内存中
+    DataObject.writeBehind 是否积累修改以后再写入数据库，默认值是Database.writeBehind
     数据对象有两种状态————与数据库关联或者从数据库分离。当它处于与数据库关联的状态时，
     使用__setitem__()或者update()设置的字段值会立即更新到数据库内。
     当它处于分离状态时，字段值只会保存在缓存内。可以使用attach()方法将分离状态转变为
     关联状态。调用attach()之后，处于缓存内的数据值会立即更新到数据库。
     有时某些字段的值比较大，可能是一篇文章或者一个图像。这种字段不适宜放在缓存中。
     可以将它的字段名加入到DataObject.notInMemory列表内。
+    如果writeBehind为True，修改的字段只记录在DataObject.dirty中，事务提交之前或者调用flush()的时候
+    才使用一条UPDATE语句写入数据库。不在事务中修改的字段要调用flush()才会写入。
     """
 
     def __init__(self, id, table, db, record = None):
@@ -182,6 +737,9 @@ class DataObject(DictProxy):
         self.detached = False
         self.notInMemory = []
         self.convertors = {}
+        self.writeBehind = db.writeBehind
+        #write-behind模式下尚未写入数据库的字段
+        self.dirty = {}
         if record is None:
             self.reload()
         else:
@@ -192,39 +750,79 @@ class DataObject(DictProxy):
 
     def __getitem__(self, k):
         if k in self.notInMemory and not self.detached:
-            cursor = self.db.conn().cursor()
-            sql = "select %s from %s where %s=?;" % (k, self.table.getName(), self.table.getPkName())
-            id = self.target()[self.table.getPkName()]
-            if sql_debug:
-                print(sql, "id=", id)
-            cursor.execute(sql, (id, ))
-            row = cursor.fetchone()
+            conn = self.db.conn()
+            try:
+                cursor = conn.cursor()
+                key = ("selectColumn", self.table, k)
+                sql = statementCache.get(key)
+                if sql is None:
+                    sql = statementCache.put(key, "select %s from %s where %s=?;" % \
+                            (k, self.table.getName(), self.table.getPkName()))
+                id = self.target()[self.table.getPkName()]
+                row = executeStatement(cursor, sql, (id, ), self.table.getName(), "selectColumn", \
+                        fetch = lambda cursor: cursor.fetchone())
+            finally:
+                self.db.releaseConn(conn)
             if row is None:
                 raise KeyError
             v = row[0]
             if sys.version_info[0] < 3 and isinstance(v, buffer):
                 v = bytes(v)
+            codec = self.table.getCodecs().get(k)
+            if codec is not None:
+                v = codec.decode(v)
         else:
             v = DictProxy.__getitem__(self, k)
         if k in self.convertors:
             return self.convertors[k](v)
         return v
 
-    @transaction
     def __setitem__(self, k, v):
         #一个小的优化，如果新值与旧值一样，就不写数据库
         changed = True
         if k not in self.notInMemory: # and not self.detached
             if k in self.target():
                 #有时候升级数据库的时候，旧的字段类型可能会和新的字段类型不一样。
-                changed = (type(self.target()[k] is not type(v) or self.target()[k] != v))
+                old = self.target()[k]
+                changed = type(old) is not type(v) or old != v
             self.target()[k] = v
-        if not self.detached and changed:
-            #实际上并不一定会更新，Database.update()会判断字段是不是数据库的字段
-            self.db.update(self.table.getName(), {k:v, "__reload_cache":False}, \
-                    "where %s=?" % self.table.getPkName(), self.id)
+        if self.detached or not changed:
+            return
+        if self.writeBehind:
+            self._markDirty({k: v})
+        else:
+            self._save({k: v})
 
     @transaction
+    def _save(self, d):
+        #实际上并不一定会更新，Database.update()会判断字段是不是数据库的字段
+        d["__reload_cache"] = False
+        self.db.update(self.table.getName(), d, "where %s=?" % self.table.getPkName(), self.id)
+
+    def _markDirty(self, d):
+        columnNames = self.table.getColumnNames()
+        for k, v in d.items():
+            if k in columnNames:
+                self.dirty[k] = v
+        #在事务中修改的话，事务提交之前写入数据库。每个事务只登记一次
+        if self.dirty and hasattr(transaction_local, "transaction"):
+            beforeCommit = transaction_local.beforeCommit
+            if self.flush not in beforeCommit:
+                beforeCommit.append(self.flush)
+
+    @transaction
+    def flush(self):
+        "把write-behind模式下积累的修改用一条UPDATE语句写入数据库。"
+        if self.detached or not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        try:
+            self._save(dirty.copy())
+        except:
+            dirty.update(self.dirty)
+            self.dirty = dirty
+            raise
+
     def update(self, d):
         d = d.copy()
         self.target().update(d)
@@ -234,8 +832,10 @@ class DataObject(DictProxy):
                     del self.target()[field]
                 except KeyError:
                     pass
-            d["__reload_cache"] = False
-            self.db.update(self.table.getName(), d, "where %s=?" % self.table.getPkName(), self.id)
+            if self.writeBehind:
+                self._markDirty(d)
+            else:
+                self._save(d)
 
     @transaction
     def deleteFromDatabase(self):
@@ -244,6 +844,9 @@ class DataObject(DictProxy):
             return
         self.db.delete(self.table.getName(), "where %s=?" % self.table.getPkName(), self.id)
         self.detached = True
+        self.dirty = {}
+        if self.db.identityMap is not None:
+            self.db.identityMap.remove((self.table.getName(), self.id))
 
     def reload(self):
         "重新载入所有数据。如果原来定义了notInMemory，最好不要使用reload()，会导致所有数据载入内存"
@@ -251,17 +854,22 @@ class DataObject(DictProxy):
         #的CRUD，根本用不到那些复杂的功能。
         if self.detached:
             return
-        rows = self.db.select(self.table.getName(), "where %s=?" % self.pk, self.id)
+        rows = self.db.select(self.table.getName(), "where %s=?" % self.table.getPkName(), self.id)
         assert len(rows) == 1
-        self.setTarget(rows[0])
+        #使用了IdentityMap的时候，select()返回的就是自己，而且已经刷新过了
+        if rows[0] is not self:
+            self.setTarget(dict(rows[0].target()))
 
     def copy(self):
         "返回一个dict，内容是该条记录，包含self.notInMemory内的字段"
         d = self.target().copy()
-        #TODO 优化一下，一次性把所有在notInMemory的字段取出来。不是很重要，因为目前大多数表格只有一个notInMemory字段。
-        if not self.detached:
-            for k in self.notInMemory:
-                d[k] = self.__getitem__(k)
+        #用一条select语句取出所有在notInMemory内的字段
+        if not self.detached and self.notInMemory:
+            id = self.target()[self.table.getPkName()]
+            columns = self.db.selectColumns(self.table.getName(), self.notInMemory, [id])
+            if id not in columns:
+                raise KeyError
+            d.update(columns[id])
         #支持convertor
         for name, convertor in self.convertors.items():
             d[name] = convertor(d[name])
@@ -272,6 +880,9 @@ class DataObject(DictProxy):
         if not self.detached:
             return
         self.db.insert(self.table.getName(), self.target())
+        self.dirty = {}
+        if self.db.identityMap is not None:
+            self.db.identityMap.put((self.table.getName(), self.id), self)
         for field in self.notInMemory:
             try:
                 del self.target()[field]
@@ -330,115 +941,450 @@ class Database(_QObject):
     def __init__(self, dbfile):
         _QObject.__init__(self)
         self.dbfile = dbfile
+        if self.identityMapSize is None:
+            self.identityMap = None
+        else:
+            self.identityMap = IdentityMap(self.identityMapSize)
         conn = self.conn()
         cursor = conn.cursor()
-        #首先创建表格。创建表格的时候使用createInitialData()方法填充基本数据。
-        if not os.path.exists(dbfile):
-            for table in self.tables:
+        #用一条语句读出现有的表格与索引。这个进程已经初始化过这个数据库文件与Database子类的话，
+        #只要表格与索引都还在，就不需要再执行任何DDL了。
+        cursor.execute("select type, name from sqlite_master where type in ('table', 'index');")
+        schema = cursor.fetchall()
+        tables = [row[1].lower() for row in schema if row[0] == "table"]
+        indexes = set(row[1].lower() for row in schema if row[0] == "index")
+        bootstrapKey = (dbfile, type(self))
+        if bootstrapKey in bootstrappedDatabases and self.schemaTableName in tables and \
+                all(table.getName().lower() in tables for table in self.tables) and \
+                all(indexName.lower() in indexes for indexName, sql in self.getIndexStatements()):
+            return
+        #首先创建尚未存在的表格。创建表格的时候使用createInitialData()方法填充基本数据。
+        for table in self.tables:
+            if table.getName().lower() not in tables:
                 sql = table.getCreateStatement()
                 if sql_debug:
                     print(sql)
                 cursor.execute(sql)
                 self.createInitialData(table)
-        else:
-            #如果数据库已经存在。从sqlite_master中读取现存表格的名字。如果有表格尚未存在，就创建它。
-            #并使用createInitialData()填充基本数据
-            cursor.execute("select name from sqlite_master where type='table';")
-            tables = [row[0].lower() for row in cursor.fetchall()]
-            for table in self.tables:
-                if table.getName().lower() not in tables:
-                    sql = table.getCreateStatement()
-                    if sql_debug:
-                        print(sql)
-                    cursor.execute(sql)
-                    self.createInitialData(table)
-        #接下来创建索引。因为创建索引与创建表格不一样，不需要填充基本数据，所以使用if not exists语句。每次
-        #都用SQL创建一遍。
+        #然后检查已经存在的表格的字段是否与Table.columns一致，不一致的话升级表格。
+        #新建的表格不需要升级，只记录签名。
+        self.upgradeSchema(cursor, tables)
+        #接下来创建索引。升级表格的时候可能删除了索引，所以重新读一遍sqlite_master
+        cursor.execute("select name, tbl_name from sqlite_master where type='index';")
+        indexes = dict((row[0].lower(), row[1].lower()) for row in cursor.fetchall())
+        created = set()
+        for indexName, sql in self.getIndexStatements():
+            created.add(indexName.lower())
+            if indexName.lower() in indexes:
+                continue
+            if sql_debug:
+                print(sql)
+            try:
+                cursor.execute(sql)
+            except sqlite3.IntegrityError:
+                #旧数据里有重复的主键，不能建唯一索引。不影响其它功能，只是这个表格不能使用upsert
+                logger.warning("can not create unique index %s because of duplicated rows.", indexName)
+                created.discard(indexName.lower())
+        self.dropLegacyPkIndexes(cursor, indexes, created)
+        bootstrappedDatabases.add(bootstrapKey)
+
+    def dropLegacyPkIndexes(self, cursor, indexes, created):
+        """早期版本的主键唯一索引命名为"主键_idx"。新的"表名_主键_idx"建好以后，
+        属于这个表格主键的旧索引就是多余的，每次写入都要多维护一个索引，所以删掉它。"""
         for table in self.tables:
-            sql = "create unique index if not exists {pkName}_idx on {tableName} ({pkName});"
-            sql = sql.format(pkName = table.getPkName(), tableName = table.getName())
+            legacyName = ("%s_idx" % table.getPkName()).lower()
+            newName = ("%s_%s_idx" % (table.getName(), table.getPkName())).lower()
+            if indexes.get(legacyName) != table.getName().lower():
+                continue
+            #Table.indexes可能正好声明了同名的索引，或者新索引没有建成，这两种情况都要保留旧索引
+            if legacyName in created or newName not in created:
+                continue
+            cursor.execute("pragma index_info(%s);" % legacyName)
+            if [row[2].lower() for row in cursor.fetchall()] != [table.getPkName().lower()]:
+                continue
+            sql = "drop index if exists %s;" % legacyName
             if sql_debug:
                 print(sql)
             cursor.execute(sql)
+
+    def getIndexStatements(self):
+        "返回(索引名, create index语句)的列表，包括主键的唯一索引与Table.indexes定义的索引"
+        statements = []
+        for table in self.tables:
+            #早期版本的主键索引名只有字段名，同一个数据库文件里几个表格的主键都叫id的时候，
+            #只有第一个表格能建成唯一索引，upsert需要的ON CONFLICT(主键)在其它表格上会失败。
+            indexName = "%s_%s_idx" % (table.getName(), table.getPkName())
+            sql = "create unique index if not exists {indexName} on {tableName} ({pkName});"
+            sql = sql.format(indexName = indexName, pkName = table.getPkName(), tableName = table.getName())
+            statements.append((indexName, sql))
             if not hasattr(table, "indexes"):
                 continue
             for index in table.indexes:
-                if isinstance(index, str):
-                    sql = "create index if not exists {columnName}_idx on {tableName} ({columnName});"
-                    sql = sql.format(columnName = index, tableName = table.getName())
+                if isinstance(index, Index):
+                    indexName = index.getName(table)
+                    sql = index.getCreateStatement(table)
+                elif isinstance(index, str):
+                    indexName = "%s_idx" % index
+                    sql = "create index if not exists {indexName} on {tableName} ({columnName});"
+                    sql = sql.format(indexName = indexName, columnName = index, tableName = table.getName())
                 elif isinstance(index, (tuple, list)):
-                    sql = "create index if not exists {columnNames1}_idx on {tableName} ({columnNames2});"
-                    columnNames1 = "_".join(index)
-                    columnNames2 = ",".join(index)
-                    sql = sql.format(columnNames1 = columnNames1, columnNames2 = columnNames2, tableName = table.getName())
-                if sql_debug:
-                    print(sql)
-                cursor.execute(sql)
-
+                    indexName = "%s_idx" % "_".join(index)
+                    sql = "create index if not exists {indexName} on {tableName} ({columnNames});"
+                    sql = sql.format(indexName = indexName, columnNames = ",".join(index), tableName = table.getName())
+                statements.append((indexName, sql))
+        return statements
 
     def createInitialData(self, table):
         "一个虚拟函数，用于创建数据初始值，参数table是表的类型(派生于Table)"
         pass
 
+    #记录各个表格结构签名的表格。几个Database子类共用同一个数据库文件，它们的表格各自升级，
+    #所以不能使用整个文件只有一个的PRAGMA user_version。
+    schemaTableName = "schema_signature"
+
+    def upgradeSchema(self, cursor, existingTables):
+        """比较每个表格的签名(参见Table.getSignature())与数据库中记录的签名，不一样的话调用upgradeTable()。
+        existingTables是启动前已经存在的表名(小写)。签名都一样的时候只需要一条select语句。"""
+        if self.schemaTableName not in existingTables:
+            sql = "create table if not exists %s (tableName text primary key, signature text);" % self.schemaTableName
+            if sql_debug:
+                print(sql)
+            cursor.execute(sql)
+            signatures = {}
+        else:
+            cursor.execute("select tableName, signature from %s;" % self.schemaTableName)
+            signatures = dict((row[0], row[1]) for row in cursor.fetchall())
+        for table in self.tables:
+            tableName = table.getName()
+            signature = table.getSignature()
+            if signatures.get(tableName) == signature:
+                continue
+            if tableName.lower() in existingTables:
+                #不管是不是真的要改表格，先开始事务。sqlite3模块只在insert/update/delete之前自动开始事务，
+                #这样alter table与复制表格的几条语句才能一起提交或者回滚。
+                if not cursor.connection.in_transaction:
+                    cursor.execute("begin;")
+                self.upgradeTable(cursor, table)
+            cursor.execute("insert or replace into %s (tableName, signature) values (?, ?);" % self.schemaTableName,
+                    (tableName, signature))
+
+    def upgradeTable(self, cursor, table):
+        """使用PRAGMA table_info读取表格现有的字段，与table.columns比较。
+        只是增加了字段的话，使用alter table add column。如果删除了字段或者字段类型变了，
+        就新建一个表格，复制共有字段的数据，删除旧表格以后再改名。删除的字段里的数据会丢失。
+        索引会在Database.__init__()里面重新创建。"""
+        tableName = table.getName()
+        cursor.execute("PRAGMA table_info(%s);" % tableName)
+        existing = dict((row[1].lower(), row[2].strip().lower()) for row in cursor.fetchall())
+        declared = dict((name.lower(), type.strip().lower()) for name, type in table.columns.items())
+        added = [name for name in table.columns if name.lower() not in existing]
+        removed = [name for name in existing if name not in declared]
+        changed = [name for name in declared if name in existing and existing[name] != declared[name]]
+        if not removed and not changed:
+            for name in added:
+                sql = "alter table %s add column %s %s;" % (tableName, name, table.columns[name])
+                if sql_debug:
+                    print(sql)
+                cursor.execute(sql)
+            if added:
+                logger.info("added columns %s to %s", ", ".join(added), tableName)
+            return
+        if removed:
+            logger.warning("dropping columns %s from %s", ", ".join(removed), tableName)
+        newName = tableName + "_upgrading"
+        common = ",".join(name for name in table.columns if name.lower() in existing)
+        columnDefination = ",".join([name + " " + type for name, type in table.columns.items()])
+        for sql in ("drop table if exists %s;" % newName,
+                "create table %s (%s);" % (newName, columnDefination),
+                "insert into %s (%s) select %s from %s;" % (newName, common, common, tableName),
+                "drop table %s;" % tableName,
+                "alter table %s rename to %s;" % (newName, tableName)):
+            if sql_debug:
+                print(sql)
+            cursor.execute(sql)
+        logger.info("rebuilt table %s", tableName)
+
     def conn(self):
+        """返回一个数据库连接。处于事务中时返回事务使用的连接，否则从连接池里取出一个自动提交的连接。
+        不在事务中取得的连接用完以后应该调用releaseConn()放回连接池。"""
         if hasattr(transaction_local, "transaction") and \
                 transaction_local.transaction:
             if transaction_local.conn is None:
-                transaction_local.conn = sqlite3.connect(self.dbfile, \
-                        detect_types = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-                transaction_local.conn.row_factory = sqlite3.Row
+                transaction_local.conn = connectionPool.acquire(self.dbfile, self.pragmas)
                 transaction_local.conn.isolation_level = "DEFERRED"
             conn = transaction_local.conn
         else:
-            conn = sqlite3.connect(self.dbfile, \
-                    detect_types = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-            conn.row_factory = sqlite3.Row
+            conn = connectionPool.acquire(self.dbfile, self.pragmas)
             conn.isolation_level = None
         return conn
 
+    def releaseConn(self, conn):
+        "把conn()取得的连接放回连接池。事务使用的连接在事务结束的时候才放回去。"
+        if getattr(transaction_local, "conn", None) is conn:
+            return
+        connectionPool.release(conn)
+
+    def close(self):
+        "关闭当前线程中这个数据库文件的空闲连接。以后再访问数据库会重新打开连接。"
+        connectionPool.close(self.dbfile)
+
+    #selectTableName()这类动态访问函数的前缀与对应的方法。较长的前缀要放在前面
+    accessorPrefixes = ("attachRows", "insertMany", "updateMany", "deleteMany", "upsertMany", "selectRows", "iterRows", \
+            "iterSelect", "select", "update", "delete", "insert", "upsert", "explain")
+
+    #iterSelect()与iterRows()每次从数据库读取的纪录数
+    fetchBatchSize = 256
+
+    #selectColumns()与prefetch()中where pk in (...)子句最多包含的参数个数。旧版本的sqlite最多只支持999个参数
+    inClauseSize = 500
+
+    #为True时，数据对象默认使用write-behind模式，参见DataObject
+    writeBehind = False
+
+    #IdentityMap使用强引用保存的最近使用过的数据对象个数。为None时不使用IdentityMap，
+    #每次select()都创建新的数据对象。IdentityMap会让select()慢一些，所以默认不使用，
+    #界面长期持有数据对象、需要同一条纪录只有一个数据对象的子类设置成256之类的值。
+    identityMapSize = None
+
+    #新建数据库连接时执行的PRAGMA，按顺序执行。子类可以覆盖这个属性。
+    #快捷面板、设置、待办事项等好几个Database子类共用同一个数据库文件，使用WAL模式以后，
+    #定时保存设置的时候不会阻塞其它连接的读取，也就很少遇到database is locked错误了。
+    #busy_timeout的单位是毫秒，数据库被锁住的时候最多等待这么长时间。
+    pragmas = (
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("cache_size", -2000),
+        ("mmap_size", 67108864),
+        ("temp_store", "MEMORY"),
+        ("busy_timeout", 5000),
+    )
+
     def __getattr__(self, attrname):
-        def wrapper(boundMethod, tableName):
-            def func(*args, **dictArgs):
-                try:
-                    return boundMethod(tableName, *args, **dictArgs)
-                except Exception as e:
-                    if __debug__:
-                        traceback.print_exc()
-                    if not isinstance(e, DatabaseException):
-                        raise DatabaseException(e)
-                    else:
-                        raise e
-            func.__name__ = boundMethod.__name__
-            return func
-
-        for method in ["select", "update", "delete", "insert"]:
-            if attrname.startswith(method):
-                if method == "select" and attrname.endswith("Ids"):
-                    tableClassName = attrname[len(method): - 3]
-                    method = "selectIds"
+        #动态访问函数第一次使用时生成，并且保存到类里面。以后再调用就是普通的属性查找了。
+        accessor = self.createAccessor(attrname)
+        if accessor is None:
+            raise AttributeError(attrname)
+        setattr(type(self), attrname, accessor)
+        return types.MethodType(accessor, self)
+
+    @classmethod
+    def createAccessor(cls, attrname):
+        """根据名字生成selectTableName(), selectTableNameIds(), insertTableName()之类的访问函数。
+        如果名字不是以accessorPrefixes内的前缀开头，返回None"""
+        #insertManyThing既可能是insertMany(Thing)也可能是insert(ManyThing)，所以找不到表格的时候还要试一下较短的前缀
+        error = None
+        for method in cls.accessorPrefixes:
+            if not attrname.startswith(method):
+                continue
+            if method == "select" and attrname.endswith("Ids"):
+                tableClassName = attrname[len(method): - 3]
+                method = "selectIds"
+            else:
+                tableClassName = attrname[len(method):]
+            try:
+                table = cls.getTableByClassName(tableClassName)
+            except InvalidTableException as e:
+                error = e
+                continue
+            return cls._makeAccessor(getattr(cls, method), table.getName(), attrname)
+        if error is not None:
+            raise error
+        return None
+
+    @staticmethod
+    def _makeAccessor(unboundMethod, tableName, attrname):
+        def accessor(self, *args, **dictArgs):
+            try:
+                return unboundMethod(self, tableName, *args, **dictArgs)
+            except Exception as e:
+                if __debug__:
+                    traceback.print_exc()
+                if not isinstance(e, DatabaseException):
+                    raise DatabaseException(e)
                 else:
-                    tableClassName = attrname[len(method):]
-                table = self.getTableByClassName(tableClassName)
-                boundMethod = getattr(self, method)
-                return wrapper(boundMethod, table.getName())
-        raise AttributeError(attrname)
+                    raise e
+        accessor.__name__ = attrname
+        return accessor
 
     def extractObject(self, cursor, table):
         "从cursor内读取数据对象，返回一列DataObject的list"
-        resultset = []
-        columns = [e[0] for e in cursor.description]
-        for row in cursor:
+        columns = [str(e[0]) for e in cursor.description]
+        return self._attachRecords(table, [self._makeRecord(table, columns, row) for row in cursor])
+
+    def _makeDataObject(self, table, columns, row):
+        "把cursor读出的一行数据转换成DataObject。columns是各列的列名。"
+        return self._attachRecord(table, self._makeRecord(table, columns, row))
+
+    def _makeRecord(self, table, columns, row):
+        "把cursor读出的一行数据转换成dict，并且使用字段的编码器解码"
+        if sys.version_info[0] < 3:
             record = {}
-            for column in columns:
-                #在Python2.6版本中column是bytes类型，并且sqlite3.Row.__getitem__()只接收bytes类型的参数
-                value = row[column]
-                if sys.version_info[0] < 3 and isinstance(value, buffer):
+            for i, column in enumerate(columns):
+                value = row[i]
+                if isinstance(value, buffer):
                     value = bytes(value)
-                record[str(column)] = value
-            id = record[table.getPkName()]
-            dataObject = DataObject(id, table, self, record)
-            resultset.append(dataObject)
-        return resultset
+                record[column] = value
+        else:
+            record = dict(zip(columns, row))
+        codecs = table.getCodecs()
+        if codecs:
+            for column, codec in codecs.items():
+                if column in record:
+                    record[column] = codec.decode(record[column])
+        return record
+
+    def _attachRecord(self, table, record):
+        "把解码以后的纪录转换成DataObject。IdentityMap里已经有这条纪录的话，刷新并返回原来的数据对象"
+        return self._attachRecords(table, [record])[0]
+
+    def _attachRecords(self, table, records):
+        "_attachRecord()的批量版本，整批纪录只锁一次IdentityMap"
+        pkName = table.getPkName()
+        if self.identityMap is None:
+            return [DataObject(record[pkName], table, self, record) for record in records]
+        tableName = table.getName()
+        keys = [(tableName, record[pkName]) for record in records]
+
+        def create(i):
+            return DataObject(keys[i][1], table, self, records[i])
+
+        def refresh(i, dataObject):
+            #已经有这条纪录的数据对象了，刷新它的字段。不在内存中的字段与尚未写入的字段保持不变
+            target = dataObject.target()
+            if not dataObject.notInMemory and not dataObject.dirty:
+                target.update(records[i])
+                return
+            for column, value in records[i].items():
+                if column in dataObject.notInMemory or column in dataObject.dirty:
+                    continue
+                target[column] = value
+
+        return self.identityMap.attachMany(keys, create, refresh)
+
+    def attachRows(self, tableName, rows, changedIds = None):
+        """把selectRows()返回的namedtuple转换成DataObject，IdentityMap里已经有的数据对象会被刷新。
+        selectRows()可以在后台线程里执行，然后在使用这些数据对象的线程里调用这个函数，
+        这样后台线程就不会修改界面正在使用的数据对象。
+        如果给出了changedIds集合，新建的以及字段值有变化的数据对象的主键会被加入这个集合。
+        一般用attachRowsTableName()的形式调用。"""
+        table = self.getTableBySqlName(tableName)
+        columns = list(table.getColumnNames())
+        pkName = table.getPkName()
+        records = [dict(zip(columns, row)) for row in rows]
+        if changedIds is not None:
+            for record in records:
+                old = None
+                if self.identityMap is not None:
+                    old = self.identityMap.peek((tableName, record[pkName]))
+                if old is None or old.detached or any(old.target().get(column) != value \
+                        for column, value in record.items() if column not in old.notInMemory):
+                    changedIds.add(record[pkName])
+        return self._attachRecords(table, records)
+
+    def _newDataObject(self, table, record):
+        "insert()使用的函数，创建关联到数据库的数据对象并放入IdentityMap"
+        id = record[table.getPkName()]
+        dataObject = DataObject(id, table, self, record)
+        if self.identityMap is not None:
+            self.identityMap.put((table.getName(), id), dataObject)
+        return dataObject
+
+    def _refreshDataObject(self, table, id, row, keys):
+        "写入数据库的时候同时刷新IdentityMap里的数据对象。不在内存中的字段与尚未写入的字段保持不变"
+        if self.identityMap is None:
+            return
+        dataObject = self.identityMap.peek((table.getName(), id))
+        if dataObject is None:
+            return
+        target = dataObject.target()
+        for k in keys:
+            if k not in dataObject.notInMemory and k not in dataObject.dirty:
+                target[k] = row[k]
+
+    def _evictDataObjects(self, table, ids):
+        "删除纪录以后把对应的数据对象移出IdentityMap"
+        if self.identityMap is None:
+            return
+        for id in ids:
+            self.identityMap.remove((table.getName(), id))
+
+    def identityMapInfo(self):
+        "返回IdentityMap的命中次数、未命中次数、命中率与数据对象的数量。没有使用IdentityMap时返回None"
+        if self.identityMap is None:
+            return None
+        return self.identityMap.info()
+
+    def selectColumns(self, tableName, fields, ids):
+        """根据主键读取一些字段，返回一个dict，键是主键，值是{字段名:值}的dict。
+        使用where pk in (...)查询，每条语句最多包含inClauseSize个主键。"""
+        table = self.getTableBySqlName(tableName)
+        fields = list(fields)
+        codecs = table.getCodecs()
+        pkName = table.getPkName()
+        ids = list(ids)
+        result = {}
+        conn = self.conn()
+        try:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            for start in range(0, len(ids), self.inClauseSize):
+                chunk = ids[start:start + self.inClauseSize]
+                sql = "select %s,%s from %s where %s in (%s);" % (pkName, ",".join(fields), tableName, \
+                        pkName, ",".join("?" * len(chunk)))
+                rows = executeStatement(cursor, sql, self.adoptTypes_List(chunk), tableName, "selectColumns", \
+                        fetch = lambda cursor: cursor.fetchall())
+                for row in rows:
+                    values = {}
+                    for field, value in zip(fields, row[1:]):
+                        if sys.version_info[0] < 3 and isinstance(value, buffer):
+                            value = bytes(value)
+                        if field in codecs:
+                            value = codecs[field].decode(value)
+                        values[field] = value
+                    result[row[0]] = values
+        finally:
+            self.releaseConn(conn)
+        return result
+
+    def prefetch(self, objects, fields = None):
+        """一次性读取一组DataObject中不在内存中的字段，比如Shortcut.icon。
+        读取以后这些字段会保存在数据对象的缓存中，并从DataObject.notInMemory中删除。
+        fields是要读取的字段，默认读取所有在notInMemory内的字段。不同表格的数据对象可以混在一起。"""
+        groups = collections.OrderedDict()
+        for dataObject in objects:
+            if dataObject.detached:
+                continue
+            wanted = [f for f in dataObject.notInMemory if fields is None or f in fields]
+            if not wanted:
+                continue
+            table = dataObject.table
+            if table not in groups:
+                groups[table] = ([], [])
+            groups[table][0].append(dataObject)
+            for field in wanted:
+                if field not in groups[table][1]:
+                    groups[table][1].append(field)
+        for table, (dataObjects, wanted) in groups.items():
+            pkName = table.getPkName()
+            ids = [dataObject.target()[pkName] for dataObject in dataObjects]
+            columns = self.selectColumns(table.getName(), wanted, ids)
+            for dataObject, id in zip(dataObjects, ids):
+                if id not in columns:
+                    continue
+                for field in wanted:
+                    if field in dataObject.notInMemory:
+                        dataObject.target()[field] = columns[id][field]
+                        dataObject.notInMemory.remove(field)
+
+    def _values(self, table, row, keys):
+        "按keys的顺序取出row中的值，用作SQL语句的参数。使用了编码器的字段会先编码。"
+        values = [row[k] for k in keys]
+        codecs = table.getCodecs()
+        if codecs:
+            for i, k in enumerate(keys):
+                if k in codecs:
+                    values[i] = codecs[k].encode(values[i])
+        return values
 
     def adoptTypes_List(self, parameters):
         """很多函数接受list类型的参数。因为sqlite3 for python 2.x需要buffer类型的blob，
@@ -466,121 +1412,551 @@ class Database(_QObject):
 
     def select(self, tableName, sql, *parameters):
         "使用select语句从数据库中取得数据。返回DataObject的列表。"
-        if sql != "":
-            sql = "select %s from %s " + sql + ";"
+        table = self.getTableBySqlName(tableName)
+        statement = self._selectStatement(table, sql)
+        parameters = self.adoptTypes_List(parameters)
+        conn = self.conn()
+        try:
+            cursor = conn.cursor()
+            return executeStatement(cursor, statement, parameters, tableName, "select", \
+                    fetch = lambda cursor: self.extractObject(cursor, table))
+        finally:
+            self.releaseConn(conn)
+
+    def explain(self, tableName, sql, *parameters):
+        """返回select()使用的查询计划，是EXPLAIN QUERY PLAN输出的detail列的列表。
+        参数与select()一样。可以用来检查查询有没有用到索引，如：
+            >>> db.explainSimpleTodo("where finishment < 100")
+            ['SEARCH simple_todo USING INDEX simple_todo_finishment_idx (finishment<?)']
+        """
+        table = self.getTableBySqlName(tableName)
+        statement = "explain query plan " + self._selectStatement(table, sql)
+        parameters = self.adoptTypes_List(parameters)
+        conn = self.conn()
+        try:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            if sql_debug:
+                print(statement, repr(parameters))
+            cursor.execute(statement, parameters)
+            return [row[-1] for row in cursor.fetchall()]
+        finally:
+            self.releaseConn(conn)
+
+    def _selectStatement(self, table, sql):
+        key = ("select", table, sql)
+        statement = statementCache.get(key)
+        if statement is None:
+            columns = ",".join(table.getColumnNames())
+            statement = statementCache.put(key, joinSql("select %s from %s" % (columns, table.getName()), sql))
+        return statement
+
+    def selectRows(self, tableName, sql, *parameters):
+        """与select()类似，但是返回只读的namedtuple列表，不创建DataObject。
+        适合只需要读取数据的地方。一般用selectRowsTableName()的形式调用。"""
+        return list(self.iterRows(tableName, sql, *parameters))
+
+    def iterRows(self, tableName, sql, *parameters, batchSize = None):
+        """与selectRows()类似，但是返回一个生成器，一边从cursor读取一边返回namedtuple。
+        生成器结束或者被关闭之前会一直占用一个数据库连接。"""
+        table = self.getTableBySqlName(tableName)
+        statement = self._selectStatement(table, sql)
+        makeRow = table.getRowClass()._make
+        columns = list(table.getColumnNames())
+        decoders = [(columns.index(column), codec) for column, codec in table.getCodecs().items()]
+        if sys.version_info[0] < 3:
+            for row in self._iterCursor(statement, parameters, batchSize, tableName, "iterRows"):
+                row = [bytes(v) if isinstance(v, buffer) else v for v in row]
+                for i, codec in decoders:
+                    row[i] = codec.decode(row[i])
+                yield makeRow(row)
+        elif decoders:
+            for row in self._iterCursor(statement, parameters, batchSize, tableName, "iterRows"):
+                row = list(row)
+                for i, codec in decoders:
+                    row[i] = codec.decode(row[i])
+                yield makeRow(row)
         else:
-            sql = "select %s from %s;"
+            for row in self._iterCursor(statement, parameters, batchSize, tableName, "iterRows"):
+                yield makeRow(row)
+
+    def iterSelect(self, tableName, sql, *parameters, batchSize = None):
+        """与select()类似，但是返回一个生成器，每次从数据库读取batchSize条纪录，逐个返回DataObject。
+        适合读取很大的表格。一般用iterSelectTableName()的形式调用。
+        注意不在事务中使用时，生成器结束之前一直持有数据库的读锁，这期间其它连接不能提交写入。"""
         table = self.getTableBySqlName(tableName)
-        columns = ",".join(table.getColumnNames())
+        statement = self._selectStatement(table, sql)
+        columns = list(table.getColumnNames())
+        for row in self._iterCursor(statement, parameters, batchSize, tableName, "iterSelect"):
+            yield self._makeDataObject(table, columns, row)
+
+    def _iterCursor(self, statement, parameters, batchSize, tableName, method):
+        """执行select语句，使用fetchmany()分批读取tuple。
+        在事务中使用时，如果事务先于生成器结束，剩下的数据会在事务提交或者回滚之前全部读进内存，
+        因为连接在事务结束以后就放回连接池了。"""
+        if batchSize is None:
+            batchSize = self.fetchBatchSize
         parameters = self.adoptTypes_List(parameters)
-        cursor = self.conn().cursor()
-        if sql_debug:
-            print(sql % (columns, tableName), repr(parameters))
-        cursor.execute(sql % (columns, tableName), parameters)
-        return self.extractObject(cursor, table)
+        conn = self.conn()
+        inTransaction = conn is getattr(transaction_local, "conn", None)
+        #不使用sqlite3.Row，直接取出tuple，省掉按列名复制的开销
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        remains = []
+        def fetchRemains():
+            remains.extend(cursor.fetchall())
+            remains.append(None) #None表示cursor已经读完了
+        beforeEnd = None
+        try:
+            #只统计执行语句的时间，读取数据的时间取决于调用者怎么使用生成器
+            executeStatement(cursor, statement, parameters, tableName, method)
+            if inTransaction:
+                beforeEnd = transaction_local.beforeEnd
+                beforeEnd.append(fetchRemains)
+            while not remains:
+                rows = cursor.fetchmany(batchSize)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+            for row in remains[:-1]:
+                yield row
+        finally:
+            if inTransaction:
+                if beforeEnd is not None and fetchRemains in beforeEnd:
+                    beforeEnd.remove(fetchRemains)
+            else:
+                self.releaseConn(conn)
 
     def selectIds(self, tableName, sql, *parameters):
         "使用select语句从数据库中取得数据的ID列表。"
-        if sql != "":
-            sql = "select %s from %s " + sql + ";"
-        else:
-            sql = "select %s from %s;"
         table = self.getTableBySqlName(tableName)
+        key = ("selectIds", table, sql)
+        statement = statementCache.get(key)
+        if statement is None:
+            statement = statementCache.put(key, joinSql("select %s from %s" % (table.getPkName(), tableName), sql))
         parameters = self.adoptTypes_List(parameters)
-        cursor = self.conn().cursor()
-        if sql_debug:
-            print(sql % (table.getPkName(), tableName), repr(parameters))
-        cursor.execute(sql % (table.getPkName(), tableName), parameters)
-        ids = []
-        #Python2.6的sqlite3.Row.__getitem__()只接受bytes类型的参数
-        if sys.version_info[0] < 3:
-            for row in cursor:
-                ids.append(row[bytes(table.getPkName())])
-        else:
-            for row in cursor:
-                ids.append(row[table.getPkName()])
-        return ids
-
-    def update(self, tableName, row, sql, *parameters):
-        "使用update更新数据库表。"
-        if sql != "":
-            sql = "update %s set %s " + sql + ";"
-        else:
-            sql = "update %s set %s;"
+        conn = self.conn()
+        try:
+            cursor = conn.cursor()
+            def fetchIds(cursor):
+                ids = []
+                #Python2.6的sqlite3.Row.__getitem__()只接受bytes类型的参数
+                if sys.version_info[0] < 3:
+                    for row in cursor:
+                        ids.append(row[bytes(table.getPkName())])
+                else:
+                    for row in cursor:
+                        ids.append(row[0])
+                return ids
+            return executeStatement(cursor, statement, parameters, tableName, "selectIds", fetch = fetchIds)
+        finally:
+            self.releaseConn(conn)
 
+    def update(self, tableName, row2, sql, *parameters):
+        "使用update更新数据库表。按主键更新的时候同时刷新IdentityMap里的数据对象。"
         table = self.getTableBySqlName(tableName)
-        parameters = self.adoptTypes_List(parameters)
-        row = self.adoptTypes_Dict(row)
-        keys = []
-        values = []
-        for key, value in row.items():
-            if key not in table.getColumnNames():
-                continue
-            keys.append(key)
-            values.append(value)
+        statement, keys = self._updateStatement(table, row2, sql)
         if len(keys) == 0:
             return
-        values.extend(parameters)
+        row = self.adoptTypes_Dict(row2)
+        values = self._values(table, row, keys)
+        values.extend(self.adoptTypes_List(parameters))
 
-        columns = ",".join([column + "=?" for column in keys])
         conn = self.conn()
-        cursor = conn.cursor()
-        if sql_debug:
-            print(sql % (tableName, columns), repr(values))
-        cursor.execute(sql % (tableName, columns), values)
+        try:
+            cursor = conn.cursor()
+            executeStatement(cursor, statement, values, tableName, "update")
+        finally:
+            self.releaseConn(conn)
+        ids = self._changedIds(table, sql, parameters)
+        if ids is not None:
+            self._refreshDataObject(table, ids[0], row2, keys)
+        self.notifyChange(table, "update", ids)
 
     def delete(self, tableName, sql, *parameters):
         "从数据库中删除数据。一般用deleteTableName()的形式调用。"
-        if sql != "":
-            sql = "delete from %s " + sql + ";"
-        else:
-            sql = "delete from %s;"
+        table = self.getTableBySqlName(tableName)
+        key = ("delete", table, sql)
+        statement = statementCache.get(key)
+        if statement is None:
+            statement = statementCache.put(key, joinSql("delete from %s" % tableName, sql))
         parameters = self.adoptTypes_List(parameters)
         conn = self.conn()
-        cursor = conn.cursor()
-        if sql_debug:
-            print(sql % tableName, repr(parameters))
-        cursor.execute(sql % tableName, parameters)
+        try:
+            cursor = conn.cursor()
+            executeStatement(cursor, statement, parameters, tableName, "delete")
+        finally:
+            self.releaseConn(conn)
+        ids = self._changedIds(table, sql, parameters)
+        if ids is not None:
+            self._evictDataObjects(table, ids)
+        self.notifyChange(table, "delete", ids)
 
     def insert(self, tableName, row2): #等下要返回DataObject，所以改名row2
         "把数据添加到数据库中。参数是一个dict类型，其中包含了一条纪录。"
         table = self.getTableBySqlName(tableName)
-        sql = "insert into %s (%s) values (%s);"
-        row = self.adoptTypes_Dict(row2)
-        keys = []
-        values = []
-        for key, value in row.items():
-            if key not in table.getColumnNames():
-                continue
-            keys.append(key)
-            values.append(value)
+        statement, keys = self._insertStatement(table, row2)
         if len(keys) == 0:
             return
+        row = self.adoptTypes_Dict(row2)
+        values = self._values(table, row, keys)
 
-        columns = ",".join(keys)
-        questions = ",".join("?" * len(keys))
         conn = self.conn()
-        cursor = conn.cursor()
-        if sql_debug:
-            print(sql % (tableName, columns, questions), repr(values))
-        cursor.execute(sql % (tableName, columns, questions), values)
-        return DataObject(row[table.getPkName()], table, self, row2)
+        try:
+            cursor = conn.cursor()
+            executeStatement(cursor, statement, values, tableName, "insert")
+        finally:
+            self.releaseConn(conn)
+        self.notifyChange(table, "insert", [row2.get(table.getPkName())])
+        return self._newDataObject(table, row2)
+
+    def subscribe(self, tableName, callback):
+        """订阅表格的修改通知，修改数据以后调用callback(action, tableName, ids)。
+        同一个数据库文件的其它Database对象做的修改也会通知。参见ChangeNotifier"""
+        changeNotifier.subscribe(self.dbfile, tableName, callback)
+
+    def unsubscribe(self, tableName, callback):
+        changeNotifier.unsubscribe(self.dbfile, tableName, callback)
+
+    def notifyChange(self, table, action, ids):
+        changeNotifier.notify(self.dbfile, table.getName(), action, ids)
+
+    def _changedIds(self, table, sql, parameters):
+        "where子句是按主键查找的话，返回被修改的主键列表。否则返回None，表示不知道修改了哪些纪录。"
+        if len(parameters) == 1 and sql.replace(" ", "") == "where%s=?" % table.getPkName():
+            return [parameters[0]]
+        return None
+
+    def _updateStatement(self, table, row, sql):
+        "返回update语句与要更新的字段名。不是数据库字段的键会被忽略。"
+        key = ("update", table, tuple(row), sql)
+        cached = statementCache.get(key)
+        if cached is None:
+            columnNames = table.getColumnNames()
+            keys = tuple(k for k in row if k in columnNames)
+            columns = ",".join([column + "=?" for column in keys])
+            statement = joinSql("update %s set %s" % (table.getName(), columns), sql)
+            cached = statementCache.put(key, (statement, keys))
+        return cached
+
+    def _insertStatement(self, table, row):
+        "返回insert语句与要插入的字段名。不是数据库字段的键会被忽略。"
+        key = ("insert", table, tuple(row))
+        cached = statementCache.get(key)
+        if cached is None:
+            columnNames = table.getColumnNames()
+            keys = tuple(k for k in row if k in columnNames)
+            columns = ",".join(keys)
+            questions = ",".join("?" * len(keys))
+            statement = "insert into %s (%s) values (%s);" % (table.getName(), columns, questions)
+            cached = statementCache.put(key, (statement, keys))
+        return cached
+
+    def _executeMany(self, batches, tableName, method):
+        "batches是(语句, 参数列表)的列表，依次使用executemany()执行。"
+        conn = self.conn()
+        try:
+            cursor = conn.cursor()
+            for statement, values in batches:
+                executeStatement(cursor, statement, values, tableName, method, many = True)
+        finally:
+            self.releaseConn(conn)
+
+    @transaction
+    def insertMany(self, tableName, rows):
+        """在一个事务中插入多条记录。参数rows是dict的列表，返回DataObject的列表。
+        字段相同的连续记录共用一条insert语句，使用executemany()一次执行。
+        一般用insertManyTableName()的形式调用。"""
+        table = self.getTableBySqlName(tableName)
+        batches = []
+        dataObjects = []
+        for row2 in rows:
+            statement, keys = self._insertStatement(table, row2)
+            if len(keys) == 0:
+                continue
+            row = self.adoptTypes_Dict(row2)
+            if not batches or batches[-1][0] != statement:
+                batches.append((statement, []))
+            batches[-1][1].append(self._values(table, row, keys))
+            dataObjects.append(self._newDataObject(table, row2))
+        self._executeMany(batches, tableName, "insertMany")
+        if dataObjects:
+            self.notifyChange(table, "insert", [dataObject.id for dataObject in dataObjects])
+        return dataObjects
+
+    def insertManyInChunks(self, tableName, rows, chunkSize = 500):
+        """导入大量纪录的时候使用。每chunkSize条纪录使用insertMany()形成一个事务提交，
+        不会长时间锁住数据库，遇到database is locked错误的时候重试这一批。返回插入的纪录数。"""
+        insertMany = retryOnBusy(self.insertMany)
+        count = 0
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunkSize:
+                count += len(insertMany(tableName, chunk))
+                chunk = []
+        if chunk:
+            count += len(insertMany(tableName, chunk))
+        return count
+
+    def _upsertStatement(self, table, row):
+        "返回insert ... on conflict do update语句与要写入的字段名。"
+        key = ("upsert", table, tuple(row))
+        cached = statementCache.get(key)
+        if cached is None:
+            columnNames = table.getColumnNames()
+            pkName = table.getPkName()
+            keys = tuple(k for k in row if k in columnNames)
+            updates = ",".join("%s=excluded.%s" % (k, k) for k in keys if k != pkName)
+            statement = "insert into %s (%s) values (%s) on conflict(%s) do " % (table.getName(), \
+                    ",".join(keys), ",".join("?" * len(keys)), pkName)
+            statement += ("update set " + updates if updates else "nothing") + ";"
+            cached = statementCache.put(key, (statement, keys))
+        return cached
+
+    @transaction
+    def upsertMany(self, tableName, rows):
+        """在一个事务中插入或者更新多条记录，主键已经存在的纪录只更新rows里给出的字段。
+        使用insert ... on conflict(主键) do update，要求主键上有唯一索引。
+        因为不知道每条纪录是插入的还是更新的，修改通知的action是"update"。
+        IdentityMap里已经有的数据对象会被刷新。一般用upsertManyTableName()的形式调用。"""
+        table = self.getTableBySqlName(tableName)
+        pkName = table.getPkName()
+        batches = []
+        ids = []
+        refreshes = []
+        for row2 in rows:
+            statement, keys = self._upsertStatement(table, row2)
+            if len(keys) == 0:
+                continue
+            ids.append(row2[pkName])
+            row = self.adoptTypes_Dict(row2)
+            if not batches or batches[-1][0] != statement:
+                batches.append((statement, []))
+            batches[-1][1].append(self._values(table, row, keys))
+            refreshes.append((row2[pkName], row2, keys))
+        self._executeMany(batches, tableName, "upsertMany")
+        #写入成功以后才刷新数据对象，否则内存与数据库会不一致
+        for id, row2, keys in refreshes:
+            self._refreshDataObject(table, id, row2, keys)
+        if ids:
+            self.notifyChange(table, "update", ids)
+
+    def upsert(self, tableName, row):
+        "插入或者更新一条纪录，参见upsertMany()。一般用upsertTableName()的形式调用。"
+        self.upsertMany(tableName, [row])
+
+    @transaction
+    def updateMany(self, tableName, rows):
+        """在一个事务中按主键更新多条记录。rows是dict的列表，每个dict都必须包含主键。
+        IdentityMap里已经有的数据对象会被刷新。一般用updateManyTableName()的形式调用。"""
+        table = self.getTableBySqlName(tableName)
+        pkName = table.getPkName()
+        where = "where %s=?" % pkName
+        batches = []
+        ids = []
+        refreshes = []
+        for row2 in rows:
+            statement, keys = self._updateStatement(table, row2, where)
+            if len(keys) == 0:
+                continue
+            ids.append(row2[pkName])
+            row = self.adoptTypes_Dict(row2)
+            if not batches or batches[-1][0] != statement:
+                batches.append((statement, []))
+            values = self._values(table, row, keys)
+            values.append(row[pkName])
+            batches[-1][1].append(values)
+            refreshes.append((row2[pkName], row2, keys))
+        self._executeMany(batches, tableName, "updateMany")
+        for id, row2, keys in refreshes:
+            self._refreshDataObject(table, id, row2, keys)
+        if ids:
+            self.notifyChange(table, "update", ids)
+
+    @transaction
+    def deleteMany(self, tableName, ids):
+        "在一个事务中按主键删除多条记录。一般用deleteManyTableName()的形式调用。"
+        table = self.getTableBySqlName(tableName)
+        key = ("deleteMany", table)
+        statement = statementCache.get(key)
+        if statement is None:
+            statement = statementCache.put(key, "delete from %s where %s=?;" % (tableName, table.getPkName()))
+        ids = list(ids)
+        values = [self.adoptTypes_List((id, )) for id in ids]
+        self._executeMany([(statement, values)], tableName, "deleteMany")
+        self._evictDataObjects(table, ids)
+        if ids:
+            self.notifyChange(table, "delete", ids)
+
+    @transaction
+    def migrateColumnCodec(self, tableName, column):
+        """把字段中旧的pickle数据改写成这个字段的编码器的格式。
+        使用前需要先把Table.columns中这个字段的类型改成json或者msgpack。
+        不能用新格式表示的值(比如json不支持的类型)保持原样，读取的时候仍然使用pickle解码。
+        返回改写的纪录数。"""
+        table = self.getTableBySqlName(tableName)
+        codec = table.getCodecs()[column]
+        pkName = table.getPkName()
+        conn = self.conn()
+        try:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute("select %s, %s from %s;" % (pkName, column, tableName))
+            values = []
+            for id, value in cursor.fetchall():
+                if value is None or codec.isEncoded(value) or not isPickled(bytes(value)):
+                    continue
+                original = pickle_loads(bytes(value))
+                try:
+                    encoded = codec.encode(original)
+                    #json会把tuple变成list，把数字键变成字符串，不报错但是解码出来不一样，这样的值也保留pickle
+                    converted = isSameValue(original, codec.decode(encoded))
+                except (TypeError, ValueError):
+                    converted = False
+                if not converted:
+                    logger.warning("can not convert %s.%s of %r to %s.", tableName, column, id, codec.tag)
+                    continue
+                values.append(self.adoptTypes_List((encoded, id)))
+        finally:
+            self.releaseConn(conn)
+        statement = "update %s set %s=? where %s=?;" % (tableName, column, pkName)
+        self._executeMany([(statement, values)], tableName, "migrateColumnCodec")
+        return len(values)
+
+    @classmethod
+    def statementCacheInfo(cls):
+        "返回SQL语句缓存的命中次数、未命中次数与缓存的语句数量。"
+        return statementCache.info()
 
     @classmethod
     def getTableBySqlName(cls, tableName):
         "根据表格的数据库名返回表格的Python类型。"
-        for table in cls.tables:
-            if table.getName() == tableName:
-                return table
-        raise InvalidTableException(tableName)
+        #按表名索引的字典保存在各个子类自己的__dict__里，避免子类之间互相覆盖
+        try:
+            tablesBySqlName = cls.__dict__["_tablesBySqlName"]
+        except KeyError:
+            tablesBySqlName = dict((table.getName(), table) for table in cls.tables)
+            cls._tablesBySqlName = tablesBySqlName
+        try:
+            return tablesBySqlName[tableName]
+        except KeyError:
+            raise InvalidTableException(tableName)
 
     @classmethod
     def getTableByClassName(cls, tableClassName):
         "根据表格的类名返回表格的Python类型。"
-        for table in cls.tables:
-            if table.__name__ == tableClassName:
-                return table
-        raise InvalidTableException(tableClassName)
+        try:
+            tablesByClassName = cls.__dict__["_tablesByClassName"]
+        except KeyError:
+            tablesByClassName = dict((table.__name__, table) for table in cls.tables)
+            cls._tablesByClassName = tablesByClassName
+        try:
+            return tablesByClassName[tableClassName]
+        except KeyError:
+            raise InvalidTableException(tableClassName)
+
+if usingPyQt5:
+    class _CallbackRelay(QObject):
+        "把后台线程里的回调函数送回创建这个对象的线程(一般是界面线程)执行"
+        called = pyqtSignal(object)
+
+        def __init__(self):
+            QObject.__init__(self)
+            self.called.connect(self.run)
+
+        def run(self, function):
+            function()
+
+
+class DatabaseExecutor:
+    """在一个专门的后台线程里执行数据库操作，界面线程不会因为读写磁盘而卡住。
+    submit(function, *args)把函数放进队列，返回concurrent.futures.Future。所有的函数都按顺序在同一个
+    线程里执行，并且每个函数都在一个事务中执行，就像使用了@transaction一样，函数里的修改一起提交或者回滚。
+    指定了callback的话，执行成功以后调用callback(result)，出错的时候调用errback(exception)，
+    没有errback就记录到日志里。有PyQt5的时候这两个回调函数在创建DatabaseExecutor的线程里执行，
+    否则在后台线程里执行。
+    注意ChangeNotifier的通知是在修改数据的线程里发出的，所以订阅了通知的界面最好不要在这里修改数据。"""
+
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "database")
+        self.workerThread = None
+        if usingPyQt5:
+            self.relay = _CallbackRelay()
+        else:
+            self.relay = None
+
+    def submit(self, function, *args, callback = None, errback = None, **kwargs):
+        future = self.executor.submit(self._run, function, args, kwargs)
+        if callback is not None or errback is not None:
+            future.add_done_callback(functools.partial(self._done, callback, errback))
+        return future
+
+    def run(self, function, *args, **kwargs):
+        """在后台线程里执行function并等待结果，前面排队的操作都会先执行完。
+        在后台线程里调用或者DatabaseExecutor已经关闭的时候直接在当前线程执行。"""
+        if threading.current_thread() is self.workerThread:
+            return transaction(function)(*args, **kwargs)
+        try:
+            future = self.submit(function, *args, **kwargs)
+        except RuntimeError:
+            return transaction(function)(*args, **kwargs)
+        return future.result()
+
+    def shutdown(self, wait = True):
+        self.executor.shutdown(wait)
+
+    def _run(self, function, args, kwargs):
+        self.workerThread = threading.current_thread()
+        return transaction(function)(*args, **kwargs)
+
+    def _done(self, callback, errback, future):
+        exception = future.exception()
+        if exception is None:
+            if callback is None:
+                return
+            function = functools.partial(callback, future.result())
+        elif errback is not None:
+            function = functools.partial(errback, exception)
+        else:
+            logger.error("database operation failed", exc_info = exception)
+            return
+        if self.relay is not None:
+            self.relay.called.emit(function)
+        else:
+            function()
+
+databaseExecutor = DatabaseExecutor()
+
+
+class Index:
+    """在Table.indexes里声明的索引。columns是一个字段名或者字段名的列表，unique为True时创建唯一索引。
+    where是部分索引(partial index)的条件，只有满足条件的纪录才会进入索引，如：
+        indexes = [Index("finishment", where = "finishment < 100")]
+    查询的where子句要直接写出同样的条件(不能使用?参数)，sqlite才会使用部分索引。
+    默认的索引名是"表名_字段名_idx"。索引已经存在的话不会重新创建，修改了定义的话要同时修改name。"""
+
+    def __init__(self, columns, unique = False, where = None, name = None):
+        if isinstance(columns, str):
+            columns = (columns, )
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.where = where
+        self.name = name
+
+    def getName(self, table):
+        if self.name is not None:
+            return self.name
+        return "%s_%s_idx" % (table.getName(), "_".join(self.columns))
+
+    def getCreateStatement(self, table):
+        sql = "create %sindex if not exists %s on %s (%s)" % ("unique " if self.unique else "", \
+                self.getName(table), table.getName(), ",".join(self.columns))
+        if self.where:
+            sql += " where " + self.where
+        return sql + ";"
+
 
 class Table:
     "用于定义表格的基础类型。"
@@ -608,6 +1984,12 @@ class Table:
         #FIXME 为pk增加unique属性
         return sql
 
+    @classmethod
+    def getSignature(cls):
+        "返回表格结构的签名，由主键与各个字段的名字、类型组成。Database.upgradeSchema()用它判断表格是否改变"
+        columns = ",".join(name + " " + type for name, type in sorted(cls.columns.items()))
+        return cls.getPkName() + ";" + columns
+
     @classmethod
     def getPkName(cls):
         """返回表格的主键名，一般是"id"，但是子类也可以定义pkName属性"""
@@ -615,6 +1997,29 @@ class Table:
             return cls.pkName
         return "id"
 
+    @classmethod
+    def getCodecs(cls):
+        "返回一个dict，键是使用了编码器的字段名，值是ColumnCodec对象。参见columnCodecs"
+        try:
+            return cls.__dict__["_codecs"]
+        except KeyError:
+            codecs = {}
+            for name, type in cls.columns.items():
+                codec = columnCodecs.get(type.strip().lower())
+                if codec is not None:
+                    codecs[name] = codec
+            cls._codecs = codecs
+            return codecs
+
+    @classmethod
+    def getRowClass(cls):
+        "返回一个namedtuple类型，字段与getColumnNames()的顺序一致。用于Database.selectRows()"
+        try:
+            return cls.__dict__["_rowClass"]
+        except KeyError:
+            cls._rowClass = collections.namedtuple(cls.__name__ + "Row", list(cls.getColumnNames()), rename = True)
+            return cls._rowClass
+
     @classmethod
     def getIndexes(cls):
         "返回表格定义的索引"
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import time
+startTime = time.perf_counter() #用于统计启动时间
 import sys
 import logging
 import os
@@ -78,7 +80,7 @@ class Platform(QObject):
         self.loadSettings()
         self.trayIcon.show()
         self.quickPanel.initWidgets()
-        logger.info("QuickPanel is launched.")
+        logger.info("QuickPanel is launched in %.0fms.", (time.perf_counter() - startTime) * 1000)
         self.quickPanel.addQuickAccessShortcut(self.tr("Tetrix"), \
                 QIcon(":/images/tetrix.png"), self.startTetrix)
         self.quickPanel.addQuickAccessShortcut(self.tr("Hello"), \
@@ -101,7 +103,8 @@ class Platform(QObject):
         self.globalKey.catched.connect(self.quickPanel.toggle)
 
     def saveSettings(self):
-        pass
+        #部件的finalize()可能刚刚修改了设置。quit()以后定时器不会再触发，所以在这里同步保存
+        self._settings.save()
 
     def configure(self):
         d = ConfigureDialog()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""对Database.pragmas做压力测试。几个写线程反复保存设置，同时几个读线程逐批读取待办事项，
+所有的表格都在同一个数据库文件里，与快捷面板的quickpanel.db一样。
+分别使用默认的WAL配置与传统的rollback journal运行一次，打印耗时与出错次数。
+用法: python3 stress_sqlite.py [写线程数] [读线程数] [每个线程的循环次数]"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+from besteam.utils.sql import Database, Table, transaction
+
+TODO_ROWS = 200
+
+class SimpleTodo(Table):
+    columns = {"id":"text", "finishment":"number", "subject":"text"}
+
+class Preference(Table):
+    pkName = "key"
+    columns = {"key":"text", "value":"blob"}
+
+class TodoDatabase(Database):
+    tables = (SimpleTodo, )
+
+class PreferenceDatabase(Database):
+    tables = (Preference, )
+
+ROLLBACK_PRAGMAS = (("journal_mode", "DELETE"), ("busy_timeout", 5000))
+
+class RollbackTodoDatabase(TodoDatabase):
+    pragmas = ROLLBACK_PRAGMAS
+
+class RollbackPreferenceDatabase(PreferenceDatabase):
+    pragmas = ROLLBACK_PRAGMAS
+
+def run(todoDatabaseClass, preferenceDatabaseClass, writers, readers, loops):
+    tempdir = tempfile.mkdtemp()
+    try:
+        dbfile = os.path.join(tempdir, "stress.db")
+        todoDb = todoDatabaseClass(dbfile)
+        preferenceDb = preferenceDatabaseClass(dbfile)
+        todoDb.insertManySimpleTodo([{"id":str(i), "finishment":0, "subject":"todo %d" % i} \
+                for i in range(TODO_ROWS)])
+        errors = []
+
+        def write(n):
+            key = "key%d" % n
+            @transaction
+            def save():
+                preferenceDb.deletePreference("where key=?", key)
+                preferenceDb.insertPreference({"key":key, "value":b"x" * 100})
+            try:
+                for i in range(loops):
+                    save()
+            except Exception as e:
+                errors.append(e)
+
+        def read():
+            try:
+                for i in range(loops):
+                    for todo in todoDb.iterSelectSimpleTodo("", batchSize = 16):
+                        pass
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target = write, args = (n, )) for n in range(writers)]
+        threads.extend(threading.Thread(target = read) for n in range(readers))
+        startTime = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - startTime
+        print("%s: %.2fs, %d errors %s" % (todoDatabaseClass.__name__, elapsed, len(errors), \
+                repr(errors[0]) if errors else ""))
+
+        #WAL模式下，iterSelect()还没有读完的时候也可以从另一个线程修改同一个表格。
+        #生成器必须一直保留到写入以后，否则它被回收的时候就已经释放了读锁
+        iterator = todoDb.iterSelectSimpleTodo("", batchSize = 16)
+        todo = next(iterator)
+        result = []
+
+        def writeDuringIteration():
+            try:
+                todoDb.updateSimpleTodo({"finishment":50}, "where id=?", todo["id"])
+                result.append("ok")
+            except Exception as e:
+                result.append(repr(e))
+        thread = threading.Thread(target = writeDuringIteration)
+        thread.start()
+        thread.join()
+        iterator.close()
+        print("write during iteration: %s" % result[0])
+        todoDb.close()
+        preferenceDb.close()
+    finally:
+        shutil.rmtree(tempdir, ignore_errors = True)
+
+if __name__ == "__main__":
+    writers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    loops = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    print("%d writer threads, %d reader threads, %d loops each, %d todos" % (writers, readers, loops, TODO_ROWS))
+    run(TodoDatabase, PreferenceDatabase, writers, readers, loops)
+    run(RollbackTodoDatabase, RollbackPreferenceDatabase, writers, readers, loops)